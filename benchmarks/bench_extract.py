@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Compare pulling the data script out of a page with BeautifulSoup (the old way) against extract.find_script.
+# Usage: python benchmarks/bench_extract.py [saved_page.html marker ...]
+# With no arguments it builds a synthetic search page roughly the size of a real one.
+
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from bs4 import BeautifulSoup
+from extract import find_script
+
+
+def synthetic_page(n_listings = 300):
+    listing = """<div class="listing"><a href="/property/{i}"><img src="/img/{i}.jpg" alt="flat"></a>
+    <h2>Flat {i}</h2><ul><li>2 bed</li><li>1 bath</li><li>Furnished</li></ul><p>Lovely flat number {i}.</p></div>\n"""
+    listings = "".join(listing.format(i = i) for i in range(n_listings))
+    ids = ",".join(str(1_000_000 + i) for i in range(n_listings))
+    return f"""<html><head><script>var analytics = {{}};</script><script src="/app.js"></script></head>
+<body>{listings}<script>
+var PROPERTYIDS = [{ids}];
+var prices = [{",".join("1500" for _ in range(n_listings))}];
+</script><footer>{"<p>footer</p>" * 200}</footer></body></html>"""
+
+
+def soup_path(html, marker):
+    soup = BeautifulSoup(html, "html.parser")
+    return soup.find(lambda tag: tag.name == "script" and marker in tag.text).text
+
+
+def scan_path(html, marker):
+    return find_script(html.encode(), marker).decode()
+
+
+def bench(name, html, marker, number = 20):
+    assert soup_path(html, marker) == scan_path(html, marker), "the two paths disagree"
+    soup_t = timeit.timeit(lambda: soup_path(html, marker), number = number) / number
+    scan_t = timeit.timeit(lambda: scan_path(html, marker), number = number) / number
+    print(f"{name} ({len(html) / 1000:.0f} kB): BeautifulSoup {soup_t * 1000:.2f} ms, find_script {scan_t * 1000:.3f} ms, {soup_t / scan_t:.0f}x faster")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args:
+        bench("synthetic openrent search page", synthetic_page(), "PROPERTYIDS")
+    for path, marker in zip(args[::2], args[1::2]):
+        bench(path, Path(path).read_text(), marker)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# Run the scrapers against saved responses served from a local HTTP server, timing each stage.
+# Usage: python benchmarks/bench_scrape.py [--fixtures DIR] [--repeat N] [--make-fixtures] [--no-save]
+#
+# The fixtures directory holds one file per kind of response:
+#   openrent_search.html          an OpenRent search results page
+#   openrent_propertiesbyid.json  a list of propertiesbyid results, answered for whichever ids are asked for
+#   rightmove_search_<index>.html each page of a Rightmove search, by its index= offset
+#   rightmove_property.html       a Rightmove property page, served for every property
+#   expected.json                 the ids a run over the fixtures should end up with
+# Save real pages under those names to benchmark against them, or use --make-fixtures to generate synthetic ones,
+# which also happens automatically if the directory is empty.
+#
+# Each run is appended to benchmarks/results.jsonl with the commit it ran on,
+# and compared with the last run from a different commit so regressions show up.
+
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse, parse_qs
+import argparse
+import json
+import logging
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HERE = Path(__file__).parent
+sys.path.insert(0, str(HERE.parent / "src"))
+from fetch import Fetcher
+from openrent import OpenRentSearch, parse_js_list
+from rightmove import RightmoveSearch, format_rightmove_properties, parse_search_page, PAGE_SIZE
+from rules import compile_rules
+from scrape import Search, run_searches
+from extract import find_script
+
+FIXTURES = HERE / "fixtures"
+RESULTS = HERE / "results.jsonl"
+OPENRENT_URL = "https://www.openrent.co.uk/properties-to-rent/london?term=London"
+RIGHTMOVE_URL = "https://www.rightmove.co.uk/property-to-rent/find.html?locationIdentifier=REGION%5E87490"
+CONFIG = {
+    "start_date": "2024-01-01",
+    # No throttling, we want to measure our code rather than our manners
+    "concurrency": {"max_workers": 4, "per_host": 4, "max_per_host": 4, "detail_workers": 8, "rate": 10_000, "burst": 10_000, "retries": 0},
+}
+SEARCHES = [
+    Search("openrent", OPENRENT_URL, max_price = 2500, keywords = ["garden", "balcony"]),
+    Search("rightmove", RIGHTMOVE_URL, max_price = 2300, min_size_square_meters = 40),
+]
+
+
+def make_fixtures(path, n_openrent = 500, n_rightmove_pages = 10, seed = 0):
+    "Write a synthetic set of fixtures, the same every time for the same arguments"
+    rng = random.Random(seed)
+    path.mkdir(parents = True, exist_ok = True)
+    filler = "<div class='listing'><p>filler</p></div>\n" * 500
+
+    ids = list(range(1_000_000, 1_000_000 + n_openrent))
+    variables = {
+        "PROPERTYIDS": ids,
+        "minimumTenancy": [rng.choice([6, 12]) for _ in ids],
+        "availableFrom": [rng.randint(0, 90) for _ in ids],
+        "isstudio": [rng.random() < .1 for _ in ids],
+        "isshared": [rng.random() < .1 for _ in ids],
+        "nonStudents": [rng.random() < .95 for _ in ids],
+        "bedrooms": [rng.randint(0, 3) for _ in ids],
+        "bathrooms": [rng.randint(1, 2) for _ in ids],
+        "gardens": [rng.random() < .3 for _ in ids],
+        "prices": [rng.randint(1200, 3000) for _ in ids],
+        "bills": [rng.random() < .2 for _ in ids],
+        "islivelistBool": [rng.random() < .95 for _ in ids],
+        "furnished": [rng.random() < .8 for _ in ids],
+        "PROPERTYLISTLATITUDES": [round(51.45 + rng.random() / 10, 6) for _ in ids],
+        "PROPERTYLISTLONGITUDES": [round(-0.2 + rng.random() / 5, 6) for _ in ids],
+        "hoursLive": [rng.randint(0, 500) for _ in ids],
+    }
+    script = "\n".join(f"var {k} = {json.dumps(v)};" for k, v in variables.items())
+    (path / "openrent_search.html").write_text(f"<html><head><script>var a = 1;</script></head><body>{filler}<script>\n{script}\n</script></body></html>")
+
+    descriptions = ["A lovely flat with a garden.", "We are proud to present this flat.", "Bright flat with a balcony.", "A flat near the station."]
+    details = [{"id": i, "title": f"{rng.randint(1, 3)} bed flat", "description": rng.choice(descriptions) * rng.randint(1, 20),
+                "letAgreed": rng.random() < .05, "imageUrl": f"//images.openrent.co.uk/{i}.jpg"} for i in ids]
+    (path / "openrent_propertiesbyid.json").write_text(json.dumps(details))
+
+    total = n_rightmove_pages * PAGE_SIZE
+    offsets = [{"value": str(i * PAGE_SIZE)} for i in range(n_rightmove_pages)]
+    for page in range(n_rightmove_pages):
+        properties = [{
+            "id": i, "bedrooms": rng.randint(1, 3), "bathrooms": 1, "summary": rng.choice(descriptions),
+            "propertyTypeFullDescription": f"{rng.randint(1, 3)} bedroom flat",
+            "price": {"amount": rng.randint(1500, 3000), "frequency": rng.choice(["monthly", "weekly"]), "currencyCode": "GBP"},
+            "propertyImages": {"mainImageSrc": f"https://media.rightmove.co.uk/{i}.jpg"},
+            "firstVisibleDate": f"2024-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}T10:00:00Z",
+            "location": {"latitude": round(51.45 + rng.random() / 10, 6), "longitude": round(-0.2 + rng.random() / 5, 6)},
+            "customer": {"brandTradingName": rng.choice(["Foxtons", "Savills", "OpenRent", "Hamptons"])},
+            "propertyUrl": f"/properties/{i}",
+        } for i in range(100_000 + page * PAGE_SIZE, 100_000 + (page + 1) * PAGE_SIZE)]
+        model = {"properties": properties, "resultCount": str(total), "pagination": {"options": offsets}}
+        (path / f"rightmove_search_{page * PAGE_SIZE}.html").write_text(f"<html><body>{filler}<script>window.jsonModel = {json.dumps(model)}</script></body></html>")
+
+    model = {"propertyData": {
+        "address": {"displayAddress": "Upper Street, London"}, "floorplans": [{"url": "https://media.rightmove.co.uk/floorplan.png"}],
+        "contactInfo": {"telephoneNumbers": {"localNumber": "020 0000 0000"}},
+        "lettings": {"furnishType": "Furnished", "letAvailableDate": "01/03/2024"}, "sizings": [{"unit": "sqm", "minimumSize": 50}],
+        "keyFeatures": ["Garden", "Balcony", "Close to the station"], "nearestStations": [{"name": "Angel"}],
+    }}
+    (path / "rightmove_property.html").write_text(f"<html><body>{filler}<script>    window.PAGE_MODEL = {json.dumps(model)}</script></body></html>")
+    (path / "expected.json").unlink(missing_ok = True)
+
+
+class FixtureServer(ThreadingHTTPServer):
+    "Answers the scrapers' requests from the fixtures directory"
+    daemon_threads = True
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        details = json.loads((fixtures / "openrent_propertiesbyid.json").read_text())
+        self.details = {str(d["id"]) : d for d in details}
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+
+    def response(self, host, path, query):
+        if path.startswith("/search/propertiesbyid"):
+            return json.dumps([self.details[i] for i in query.get("ids", []) if i in self.details]).encode(), "application/json"
+        if "openrent" in host and path.startswith("/properties-to-rent"):
+            return (self.fixtures / "openrent_search.html").read_bytes(), "text/html"
+        if "rightmove" in host and path.startswith("/property-to-rent"):
+            page = self.fixtures / f"rightmove_search_{query.get('index', ['0'])[0]}.html"
+            return (page.read_bytes(), "text/html") if page.exists() else (None, None)
+        if "rightmove" in host and path.startswith("/properties/"):
+            return (self.fixtures / "rightmove_property.html").read_bytes(), "text/html"
+        return None, None
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        u = urlparse(self.path)
+        body, content_type = self.server.response(self.headers.get("X-Original-Host", ""), u.path, parse_qs(u.query))
+        with self.server.requests_lock:
+            self.server.requests += 1
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalAdapter(HTTPAdapter):
+    "Sends every request to the fixture server instead of the host in its url"
+
+    def __init__(self, address, **kwargs):
+        super().__init__(**kwargs)
+        self.netloc = "%s:%d" % address
+
+    def send(self, request, **kwargs):
+        u = urlparse(request.url)
+        request.headers["X-Original-Host"] = u.netloc
+        request.url = urlunparse(u._replace(scheme = "http", netloc = self.netloc))
+        return super().send(request, **kwargs)
+
+
+class NothingSeen:
+    "A seen store that's never seen anything, so every run does the same work"
+    def seen_many(self, ids): return set()
+    def add_many(self, ids): pass
+    def count_failures(self, ids, limit): return set()
+
+
+def timed(func, repeat):
+    "Run func repeat times, returning its last result and the median time in ms"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(times)
+
+
+def run(fixtures, repeat):
+    server = FixtureServer(fixtures)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    session = requests.Session()
+    adapter = LocalAdapter(server.server_address, pool_maxsize = 16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    fetcher = Fetcher.from_config(session, CONFIG)
+    stages = {}
+
+    # The pure parsing steps, straight off the fixtures without any HTTP
+    openrent_page = (fixtures / "openrent_search.html").read_bytes()
+    script = find_script(openrent_page, "PROPERTYIDS").decode()
+    lists = [data for _, data in re.findall(r"var\s(\S+)\s?=\s?(\[[^\]]*\])", script)]
+    _, stages["openrent.parse_js_list"] = timed(lambda: [parse_js_list(s) for s in lists], repeat)
+    raw = rightmove_results(fixtures)
+    _, stages["rightmove.format_rightmove_properties"] = timed(lambda: [format_rightmove_properties(p) for p in raw], repeat)
+
+    # Each stage of a search, going over HTTP to the fixture server
+    openrent, stages["openrent.make_request"] = timed(lambda: OpenRentSearch("openrent", OPENRENT_URL).make_request(fetcher), repeat)
+    _, stages["openrent.more_info"] = timed(lambda: openrent.more_info(fetcher), repeat)
+    rightmove, stages["rightmove.make_request"] = timed(lambda: RightmoveSearch("rightmove", RIGHTMOVE_URL).make_request(fetcher), repeat)
+    _, stages["rightmove.more_info"] = timed(lambda: rightmove.more_info(fetcher), repeat)
+    properties = list(openrent.properties.values()) + list(rightmove.properties.values())
+    rules = compile_rules(dict(CONFIG, start_date = datetime(2024, 1, 1, tzinfo = timezone.utc)), SEARCHES[0])
+    _, stages["rules"] = timed(lambda: [rules(p) for p in properties], repeat)
+
+    # And the whole thing end to end
+    tracemalloc.start()
+    found, total_ms = timed(lambda: run_searches(SEARCHES, dict(CONFIG), fetcher, NothingSeen()), repeat)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    server.shutdown()
+    parsed = len(openrent.properties) + len(rightmove.properties)
+    return {
+        "properties": parsed,
+        "found": sorted(found),
+        "properties_per_sec": parsed / total_ms * 1000,
+        "end_to_end_ms": total_ms,
+        "peak_memory_mb": peak / 1024 / 1024,
+        "requests": server.requests,
+        "stages_ms": stages,
+    }
+
+
+def rightmove_results(fixtures):
+    "The raw properties from every saved page of Rightmove results"
+    results = []
+    for page in sorted(fixtures.glob("rightmove_search_*.html"), key = lambda p: int(p.stem.rsplit("_", 1)[1])):
+        response = requests.Response()
+        response._content = page.read_bytes()
+        response.encoding = "utf-8"
+        results += parse_search_page(response)["properties"]
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = HERE, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_result(current_commit):
+    "The last saved result from a different commit, if there is one"
+    if not RESULTS.exists(): return None
+    results = [json.loads(line) for line in RESULTS.read_text().splitlines() if line.strip()]
+    others = [r for r in results if r["commit"] != current_commit]
+    return others[-1] if others else None
+
+
+def report(result, previous):
+    def change(new, old):
+        return f" ({(new - old) / old:+.0%} vs {previous['commit']})" if old else ""
+    def metric(name, key, fmt):
+        old = previous.get(key) if previous else None
+        print(f"{name}: {fmt.format(result[key])}{change(result[key], old) if old else ''}")
+
+    metric("Throughput", "properties_per_sec", "{:.0f} properties/sec")
+    metric("End to end", "end_to_end_ms", "{:.1f} ms")
+    metric("Peak memory", "peak_memory_mb", "{:.1f} MB")
+    print(f"{result['properties']} properties parsed with {result['requests']} requests, {len(result['found'])} kept")
+    for stage, ms in result["stages_ms"].items():
+        old = previous["stages_ms"].get(stage) if previous else None
+        print(f"  {stage}: {ms:.2f} ms{change(ms, old) if old else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the scrapers against saved responses")
+    parser.add_argument("--fixtures", type = Path, default = FIXTURES)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--make-fixtures", action = "store_true", help = "write synthetic fixtures, replacing any there")
+    parser.add_argument("--no-save", action = "store_true", help = "don't append this run to results.jsonl")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.make_fixtures or not (args.fixtures / "openrent_search.html").exists():
+        make_fixtures(args.fixtures)
+    result = run(args.fixtures, args.repeat)
+
+    # The same fixtures should always give the same properties, if they don't something has changed behaviour
+    expected_path = args.fixtures / "expected.json"
+    if not expected_path.exists():
+        expected_path.write_text(json.dumps(result["found"], indent = 1))
+    expected = json.loads(expected_path.read_text())
+    if result["found"] != expected:
+        missing, extra = set(expected) - set(result["found"]), set(result["found"]) - set(expected)
+        print(f"REGRESSION: {len(missing)} expected properties missing, {len(extra)} unexpected ones found")
+        print(f"  missing: {sorted(missing)[:10]}\n  extra: {sorted(extra)[:10]}")
+
+    result.update(commit = commit(), date = datetime.now(timezone.utc).isoformat(), fixtures = str(args.fixtures))
+    report(result, previous_result(result["commit"]))
+    if not args.no_save:
+        with open(RESULTS, "a") as f:
+            f.write(json.dumps({k : v for k, v in result.items() if k != "found"}) + "\n")
+    sys.exit(result["found"] != expected)
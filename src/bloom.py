@@ -0,0 +1,77 @@
+from hashlib import blake2b
+from math import ceil, log
+from pathlib import Path
+import mmap
+import struct
+import threading
+
+# File layout: a small header followed by the bit array, which we mmap so lookups don't need the file read into memory
+HEADER = struct.Struct("<8sQQQQ") # magic, number of bits, number of hashes, capacity, number of ids added
+MAGIC = b"RENTBLM1"
+
+
+def optimal_size(capacity, error_rate):
+    "The number of bits and hashes needed to hold capacity items with the given false positive rate"
+    bits = ceil(-capacity * log(error_rate) / log(2) ** 2)
+    hashes = max(1, round(bits / capacity * log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """A memory mapped Bloom filter of strings.
+    `x in bloom` is never False for something that was added but may be True for something that wasn't."""
+
+    def __init__(self, path, capacity = 1_000_000, error_rate = 0.001):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        if not self.path.exists():
+            self.create(capacity, error_rate)
+        self.open()
+
+    def create(self, capacity, error_rate):
+        bits, hashes = optimal_size(capacity, error_rate)
+        with open(self.path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, bits, hashes, capacity, 0))
+            f.truncate(HEADER.size + ceil(bits / 8))
+
+    def open(self):
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.bits, self.hashes, self.capacity, _ = HEADER.unpack_from(self.map)
+        if magic != MAGIC: raise ValueError(f"{self.path} isn't a Bloom filter")
+
+    @property
+    def count(self):
+        return HEADER.unpack_from(self.map)[4]
+
+    def positions(self, item):
+        # Double hashing, k positions from the two halves of one 128 bit hash
+        digest = blake2b(item.encode(), digest_size = 16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def __contains__(self, item):
+        m = self.map
+        return all(m[HEADER.size + (p >> 3)] & (1 << (p & 7)) for p in self.positions(item))
+
+    def add_many(self, items):
+        with self.lock:
+            m, n = self.map, 0
+            for item in items:
+                for p in self.positions(item):
+                    m[HEADER.size + (p >> 3)] |= 1 << (p & 7)
+                n += 1
+            HEADER.pack_into(m, 0, MAGIC, self.bits, self.hashes, self.capacity, self.count + n)
+
+    def rebuild(self, items, capacity, error_rate = 0.001):
+        "Start again from scratch with just items in the filter"
+        with self.lock:
+            self.close()
+            self.create(capacity, error_rate)
+            self.open()
+        self.add_many(items)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# The command line entry point.
+#   python src/cli.py run                    run every search and post what they find to slack, what cron should call
+#   python src/cli.py dry-run                run every search and log what they find, without touching slack or the seen list
+#   python src/cli.py search NAME [NAME...]  run just some of the searches, add --dry-run to only log what they find
+#   python src/cli.py daemon                 keep running, polling each search on its own interval
+#   python src/cli.py tenants RUNNER_CONFIG  run the searches of everyone listed in a runner config, sharing the fetching
+# The scraping modules are only imported once we know what we're doing, so `--help` and friends come back straight away,
+# and numpy and slack_sdk only get loaded by the runs that need them.
+
+import time
+PROCESS_STARTED = time.perf_counter()
+
+import argparse
+import sys
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = "Find new rentals on OpenRent and Rightmove and post them to slack")
+    parser.add_argument("--config", default = "data/config.yml", help = "path to the config file (default: %(default)s)")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    commands.add_parser("run", help = "run every search and post new properties to slack")
+    commands.add_parser("dry-run", help = "run every search and log new properties, without slack or remembering them")
+    search = commands.add_parser("search", help = "run only the named searches")
+    search.add_argument("names", nargs = "+", metavar = "NAME")
+    search.add_argument("--dry-run", action = "store_true", help = "log new properties instead of posting them")
+    commands.add_parser("daemon", help = "keep running, polling each search on its own interval")
+    tenants = commands.add_parser("tenants", help = "run several people's configs at once, sharing fetches between them")
+    tenants.add_argument("runner_config", help = "yaml listing the tenants' config files and what they share")
+    tenants.add_argument("--dry-run", action = "store_true", help = "log new properties instead of posting them")
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    args = parse_args(argv)
+
+    if args.command == "daemon":
+        import signal
+        from daemon import Daemon
+        daemon = Daemon(args.config)
+        signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+        daemon.run()
+        return 0
+
+    if args.command == "tenants":
+        import scrape
+        from tenants import run_tenants
+        from metrics import metrics
+        runner_config = scrape.load_config(args.runner_config)
+        scrape.setup_logging()
+        metrics.observe("startup", time.perf_counter() - PROCESS_STARTED)
+        run_tenants(runner_config, dry_run = args.dry_run)
+        metrics.write_from_config(runner_config)
+        return 0
+
+    import scrape
+    names = args.names if args.command == "search" else None
+    if names:
+        # Check the names before doing anything, a typo shouldn't need a traceback to spot
+        try: scrape.select_searches(scrape.load_config(args.config), names)
+        except ValueError as e:
+            print(e, file = sys.stderr)
+            return 2
+
+    scrape.main(
+        args.config,
+        search_names = names,
+        dry_run = args.command == "dry-run" or getattr(args, "dry_run", False),
+        process_started = PROCESS_STARTED,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
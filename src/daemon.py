@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Run the scraper as a long lived process instead of from cron.
+# The session, HTTP cache, seen store, slack client and config are set up once and kept warm,
+# and every search is run on its own interval, so busy areas can be polled every minute or two.
+
+from datetime import datetime
+from pathlib import Path
+from random import uniform
+import heapq
+import os
+import signal
+import time
+
+import logging
+logger = logging.getLogger("")
+
+from scrape import (
+    CONFIG_PATH, Search, load_config, setup_logging, run_searches, post_debug_message,
+)
+from delivery import SlackDelivery, SeenOrQueued, open_outbox
+from fetch import Fetcher, make_session
+from seen import open_seen_store
+from httpcache import open_http_cache
+from dedup import open_listing_index
+from details import open_detail_store
+from history import open_history
+from metrics import metrics
+
+
+class Daemon:
+    def __init__(self, config_path = CONFIG_PATH):
+        self.config_path = Path(config_path)
+        self.slack_logs = setup_logging()
+        self.running = True
+        self.seen = self.cache = self.session = None
+        self.outbox = self.listings = self.details = self.history = None
+        self.load()
+
+    def load(self):
+        "(Re)load the config and everything that depends on it"
+        self.config_mtime = os.stat(self.config_path).st_mtime
+        config = load_config(self.config_path)
+        old = getattr(self, "config", {})
+
+        # Only reopen things whose settings have actually changed
+        if self.seen is None or (old.get("checked_properties_list"), old.get("seen_store")) != (config["checked_properties_list"], config.get("seen_store")):
+            if self.seen is not None: self.seen.close()
+            self.seen = open_seen_store(config)
+        if self.outbox is None or old.get("outbox") != config.get("outbox"):
+            if self.outbox is not None: self.outbox.close()
+            self.outbox = open_outbox(config)
+        if self.session is None or old.get("http_cache") != config.get("http_cache"):
+            self.close_session()
+            self.cache = open_http_cache(config)
+            self.session = make_session(cache = self.cache)
+        if self.listings is None or old.get("dedup") != config.get("dedup"):
+            if self.listings is not None: self.listings.close()
+            self.listings = open_listing_index(config)
+        if self.details is None or old.get("openrent_details") != config.get("openrent_details"):
+            if self.details is not None: self.details.close()
+            self.details = open_detail_store(config)
+        if self.history is None or old.get("history") != config.get("history"):
+            if self.history is not None: self.history.close()
+            self.history = open_history(config)
+        if old.get("slack_token") != config["slack_token"]:
+            from slack_sdk import WebClient
+            self.sc = WebClient(token = config["slack_token"])
+
+        self.config = config
+        self.fetcher = Fetcher.from_config(self.session, config)
+        self.searches = {s["name"] : Search(**s) for s in config["searches"]}
+
+        # Start every search off at a random point in its first interval so they don't all go at once
+        self.queue = [(time.time() + uniform(0, self.interval(s)), name) for name, s in self.searches.items()]
+        heapq.heapify(self.queue)
+        self.last_debug_post = 0
+        logger.info(f"Loaded {len(self.searches)} searches from {self.config_path}")
+
+    def interval(self, search_info):
+        "Seconds until a search should next run"
+        minutes = search_info.interval_minutes or self.config.get("poll_interval_minutes", 15)
+        jitter = self.config.get("poll_jitter", 0.1)
+        return minutes * 60 * uniform(1 - jitter, 1 + jitter)
+
+    def config_changed(self):
+        try: return os.stat(self.config_path).st_mtime != self.config_mtime
+        except FileNotFoundError: return False
+
+    def due(self):
+        "Wait for the next search to be due then pop it and any others that are due at the same time"
+        while self.running and (not self.queue or self.queue[0][0] > time.time()):
+            time.sleep(max(0, min(1, self.queue[0][0] - time.time())) if self.queue else 1)
+            if self.config_changed():
+                logger.info("Config changed, reloading.")
+                try: self.load()
+                except Exception: logger.exception(f"Couldn't reload {self.config_path}, carrying on with the old config")
+
+        due = []
+        while self.queue and self.queue[0][0] <= time.time():
+            name = heapq.heappop(self.queue)[1]
+            if name in self.searches: due.append(self.searches[name])
+        return due
+
+    def run_once(self, search_infos):
+        self.slack_logs.seek(0)
+        self.slack_logs.truncate()
+        metrics.reset()
+
+        started = time.time()
+        delivery = SlackDelivery.from_config(self.sc, self.outbox, self.seen, self.config)
+        streaming = self.config.get("streaming", False)
+        properties = run_searches(
+            search_infos, self.config, self.fetcher, SeenOrQueued(self.seen, self.outbox), self.listings, self.details, self.history,
+            deliver = (lambda properties: delivery.deliver_now(self.config, properties)) if streaming else None,
+        )
+        logger.info(f"{', '.join(s.name for s in search_infos)} found {len(properties)} new properties.")
+        if self.cache is not None:
+            # The cache stays open between runs, so keep it to max_size_mb now rather than waiting for close()
+            self.cache.evict()
+            logger.info(self.cache.summary())
+
+        # Don't flood the debug channel when polling every minute, only post when there's news or it's been a while
+        debug_every = self.config.get("debug_interval_minutes", 60) * 60
+        if properties or time.time() - self.last_debug_post > debug_every:
+            post_debug_message(self.sc, self.config, properties, self.slack_logs.getvalue())
+            self.last_debug_post = time.time()
+        if self.history is not None: delivery.queue_price_drops(self.config, self.history.price_drops(started))
+        delivery.deliver(self.config, {} if streaming else properties)
+        metrics.write_from_config(self.config)
+
+    def run(self):
+        logger.info(f"Daemon started at {datetime.now().strftime('%d %b %y %H:%M')}")
+        try:
+            while self.running:
+                search_infos = self.due()
+                if not search_infos: continue
+                try:
+                    self.run_once(search_infos)
+                except Exception:
+                    # One bad run shouldn't take the whole daemon down, try again next time round
+                    logger.exception(f"Error while running {', '.join(s.name for s in search_infos)}")
+                for s in search_infos:
+                    heapq.heappush(self.queue, (time.time() + self.interval(s), s.name))
+        finally:
+            self.close()
+
+    def stop(self):
+        self.running = False
+
+    def close_session(self):
+        if self.session is not None: self.session.close()
+        if self.cache is not None: self.cache.close()
+
+    def close(self):
+        self.close_session()
+        self.seen.close()
+        self.outbox.close()
+        if self.listings is not None: self.listings.close()
+        if self.details is not None: self.details.close()
+        if self.history is not None: self.history.close()
+
+
+if __name__ == "__main__":
+    daemon = Daemon()
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    daemon.run()
@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+from pathlib import Path
+from urllib.parse import quote
+
+
+# How long to wait for another process to finish writing before giving up with "database is locked",
+# the tenant runner's workers all share the HTTP cache and OpenRent details
+BUSY_TIMEOUT = 30
+
+
+def connect(path, read_only = False):
+    """Open a sqlite database that can be shared between our worker threads, and other processes.
+    A read_only one has to exist already and is left exactly as it is, journal mode and all."""
+    if read_only:
+        return sqlite3.connect(
+            f"file:{quote(str(Path(path).resolve()))}?mode=ro", uri = True,
+            timeout = BUSY_TIMEOUT, check_same_thread = False, isolation_level = None,
+        )
+    Path(path).parent.mkdir(parents = True, exist_ok = True)
+    conn = sqlite3.connect(path, timeout = BUSY_TIMEOUT, check_same_thread = False, isolation_level = None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+class Database:
+    "Base class for our little sqlite stores, serialises access to one connection behind a lock"
+    schema = ""
+
+    def __init__(self, path, read_only = False):
+        self.path = str(path)
+        self.conn = connect(self.path, read_only)
+        self.lock = threading.RLock()
+        # Opening read only is for looking at what's there, so don't even create missing tables
+        if read_only: return
+        with self.lock:
+            self.conn.executescript(self.schema)
+
+    def execute(self, sql, params = ()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def chunks(li, size = 500):
+    "Split a list into chunks small enough to go in an sqlite IN (...) clause"
+    for i in range(0, len(li), size):
+        yield li[i : i + size]
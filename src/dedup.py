@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta, timezone
+from functools import cache
+from hashlib import blake2b
+from math import radians, cos, floor
+import re
+
+from utils import lazy_import
+np = lazy_import("numpy")
+
+import logging
+logger = logging.getLogger("")
+
+from db import Database
+from geo import haversine_m
+
+# The same flat often gets listed on more than one portal, or relisted a few weeks later.
+# To spot that we keep an index of the properties we've posted, bucketed into a grid of roughly 100m squares.
+# A new property is compared with everything in the squares around it and counts as a duplicate if it's close by,
+# has the same number of bedrooms, a similar price, and a similar description by MinHash.
+# Descriptions are only compared between listings on the same portal, agents write a new one for each portal,
+# so across portals we go on location, price and bedrooms alone and need both of those to be known.
+
+CELL_DEGREES = 0.001 # about 110m of latitude, 70m of longitude in London
+N_HASHES = 64
+PRIME = 4294967311 # first prime above 2**32
+
+
+@cache
+def hash_coefficients():
+    "The a and b of the N_HASHES hash functions a * h + b, made on first use so numpy isn't loaded until it's needed"
+    rng = np.random.default_rng(0) # fixed seed, signatures have to be comparable between runs
+    return rng.integers(1, 2**31, N_HASHES, dtype = np.uint64), rng.integers(0, 2**31, N_HASHES, dtype = np.uint64)
+
+
+def shingles(text, size = 2):
+    "The set of runs of `size` consecutive words in some text"
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    return {" ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 0))}
+
+
+def minhash(text):
+    "A MinHash signature of text's shingles, the fraction of positions where two signatures agree estimates their Jaccard similarity"
+    hashes = np.array([int.from_bytes(blake2b(s.encode(), digest_size = 4).digest(), "little") for s in shingles(text)], dtype = np.uint64)
+    if not len(hashes): return None
+    # a * h + b stays under 2**64 because a, b < 2**31 and h < 2**32
+    a, b = hash_coefficients()
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % PRIME).min(axis = 1)
+
+
+def similarity(sig1, sig2):
+    return float(np.mean(sig1 == sig2))
+
+
+def portal(id_):
+    "The portal a property id comes from, ids look like rightmove:123"
+    return id_.split(":", 1)[0]
+
+
+def cell(lat, lon):
+    return floor(lat / CELL_DEGREES), floor(lon / CELL_DEGREES)
+
+
+class ListingIndex(Database):
+    "Properties we've posted, indexed by location, kept between runs"
+    schema = """
+        CREATE TABLE IF NOT EXISTS listings (
+            id TEXT PRIMARY KEY,
+            cell_lat INTEGER NOT NULL,
+            cell_lon INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            price REAL,
+            bedrooms INTEGER,
+            signature BLOB,
+            added_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS cell_idx ON listings (cell_lat, cell_lon);
+        CREATE INDEX IF NOT EXISTS added_at_idx ON listings (added_at);
+    """
+
+    def __init__(self, path, radius_m = 150, price_tolerance = 0.05, min_similarity = 0.3, ttl_days = 90):
+        super().__init__(path)
+        self.radius_m = radius_m
+        self.price_tolerance = price_tolerance
+        self.min_similarity = min_similarity
+        if ttl_days:
+            cutoff = (datetime.now(timezone.utc) - timedelta(days = ttl_days)).timestamp()
+            self.execute("DELETE FROM listings WHERE added_at < ?", (cutoff,))
+
+    def add(self, prop, signature):
+        lat, lon = cell(prop.latitude, prop.longitude)
+        self.execute(
+            "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (prop.id, lat, lon, float(prop.latitude), float(prop.longitude),
+             None if prop.price is None else float(prop.price),
+             None if prop.bedrooms is None else int(prop.bedrooms),
+             None if signature is None else signature.tobytes(), datetime.now(timezone.utc).timestamp()),
+        )
+
+    def find_duplicate(self, prop, signature):
+        "The id of a listing we already have that looks like the same flat as prop, or None"
+        lat, lon = cell(prop.latitude, prop.longitude)
+        # Search enough cells either side to cover radius_m
+        reach = int(self.radius_m / (CELL_DEGREES * 111_000 * cos(radians(prop.latitude)))) + 1
+        candidates = self.execute(
+            "SELECT id, latitude, longitude, price, bedrooms, signature FROM listings "
+            "WHERE cell_lat BETWEEN ? AND ? AND cell_lon BETWEEN ? AND ? AND id != ?",
+            (lat - reach, lat + reach, lon - reach, lon + reach, prop.id),
+        )
+        for id_, c_lat, c_lon, price, bedrooms, c_signature in candidates:
+            if haversine_m(prop.latitude, prop.longitude, c_lat, c_lon) > self.radius_m: continue
+            if bedrooms is not None and prop.bedrooms is not None and bedrooms != prop.bedrooms: continue
+            if price and prop.price and abs(price - prop.price) > self.price_tolerance * price: continue
+            if portal(id_) != portal(prop.id):
+                # Descriptions aren't comparable across portals, so the price and bedrooms have to have matched
+                if not (price and prop.price and bedrooms is not None and prop.bedrooms is not None): continue
+                return id_
+            # Only compare descriptions if we have both of them
+            if signature is not None and c_signature is not None:
+                if similarity(signature, np.frombuffer(c_signature, dtype = np.uint64)) < self.min_similarity: continue
+            return id_
+        return None
+
+    def drop_duplicates(self, properties):
+        """Remove properties that duplicate one we've already posted, or an earlier one in properties,
+        and add the rest to the index. Returns the properties left and the ids of the duplicates."""
+        kept, duplicates = {}, []
+        for id_, prop in properties.items():
+            if prop.latitude is None or prop.longitude is None:
+                kept[id_] = prop
+                continue
+            signature = minhash(f"{prop.title or ''} {prop.description or ''}")
+            original = self.find_duplicate(prop, signature)
+            if original:
+                logger.info(f"👯 {id_} looks like a repost of {original}")
+                duplicates.append(id_)
+                continue
+            self.add(prop, signature)
+            kept[id_] = prop
+        return kept, duplicates
+
+
+def open_listing_index(config):
+    "Open the duplicate listing index configured by the optional dedup block, or None if there isn't one"
+    options = config.get("dedup")
+    if not options: return None
+    return ListingIndex(
+        options.get("path", "data/listings.sqlite"),
+        radius_m = options.get("radius_m", 150),
+        price_tolerance = options.get("price_tolerance", 0.05),
+        min_similarity = options.get("min_similarity", 0.3),
+        ttl_days = options.get("ttl_days", 90),
+    )
@@ -0,0 +1,245 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import time
+
+import logging
+logger = logging.getLogger("")
+
+from db import Database
+from utils import fmt_timedelta
+from metrics import metrics
+
+
+def floorplan(url):
+    return {
+        "type": "image",
+        "title": {"type": "plain_text", "text": "Floorplan", "emoji": True},
+        "image_url": url,
+        "alt_text": "Floor Plan",
+    }
+
+
+# Slack rejects a section whose text is longer than this, and with it the whole message
+SECTION_TEXT_MAX = 3000
+
+
+def truncate(text, limit = SECTION_TEXT_MAX):
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def property_description(p):
+    block = {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": truncate(f"""
+<{p.url}|{p.title}>
+£{p.price} {'incl bills' if p.includesBills else ''}| {p.bedrooms} bed | Start {p.availableFrom.strftime('%d %b %y') if p.availableFrom else "?"} {'| UNFURNISHED!' if p.isFurnished == False else ''} {f'| {p.size} sq m' if p.size else ''}
+On {p.agent} for {fmt_timedelta(p.listedAt)}.
+{f"Nearest Station: {p.nearestStation}" if p.nearestStation else ""}
+{f"Keywords: {' '.join(s.capitalize() for s in p.keywords)}" if p.keywords else ""}
+{p.description}
+            """),
+        },
+    }
+    # Slack rejects the whole message if an image has no url
+    if p.imgUrl:
+        block["accessory"] = {
+            "type": "image",
+            "image_url": p.imgUrl,
+            "alt_text": "Image of the flat",
+        }
+    return block
+
+
+def price_drops_description(drops):
+    return {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "\n".join(f"<{url}|{title or id_}> £{old:.0f} → £{new:.0f}" for id_, title, url, old, new in drops),
+        },
+    }
+
+
+DIVIDER_BLOCK = {"type": "divider"}
+
+
+class Outbox(Database):
+    "Slack messages waiting to be sent, kept on disk so that nothing is lost if posting fails"
+    schema = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            text TEXT NOT NULL,
+            blocks TEXT NOT NULL,
+            property_ids TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+    """
+
+    def add(self, channel, text, blocks, property_ids):
+        "Queue a message, returning its id"
+        with self.lock:
+            return self.conn.execute(
+                "INSERT INTO outbox (channel, text, blocks, property_ids, created_at) VALUES (?, ?, ?, ?, ?)",
+                (channel, text, json.dumps(blocks), json.dumps(property_ids), datetime.now(timezone.utc).timestamp()),
+            ).lastrowid
+
+    def pending(self):
+        rows = self.execute("SELECT id, channel, text, blocks, property_ids, attempts FROM outbox ORDER BY id")
+        return [(id_, channel, text, json.loads(blocks), json.loads(ids), attempts) for id_, channel, text, blocks, ids, attempts in rows]
+
+    def property_ids(self):
+        return {i for row in self.execute("SELECT property_ids FROM outbox") for i in json.loads(row[0])}
+
+    def remove(self, id_):
+        self.execute("DELETE FROM outbox WHERE id = ?", (id_,))
+
+    def failed(self, id_):
+        self.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (id_,))
+
+
+class SeenOrQueued:
+    "A view of the seen store that also counts properties waiting in the outbox as seen, so they don't get queued twice"
+
+    def __init__(self, seen, outbox):
+        self.seen = seen
+        self.queued = outbox.property_ids()
+
+    def seen_many(self, ids):
+        ids = list(ids)
+        return self.seen.seen_many(ids) | (set(ids) & self.queued)
+
+    def add_many(self, ids):
+        self.seen.add_many(ids)
+
+    def count_failures(self, ids, limit):
+        return self.seen.count_failures(ids, limit)
+
+
+class SlackDelivery:
+    """Posts properties to slack several to a message, going through the outbox.
+    Properties are only marked as seen once the message they're in has been posted.
+    Make a new one for each run, a message's attempts only go up once per run however many times it gets flushed."""
+
+    def __init__(self, sc, outbox, seen, properties_per_message = 10, max_attempts = 5, max_retry_wait = 120):
+        self.sc = sc
+        self.outbox = outbox
+        self.seen = seen
+        self.properties_per_message = properties_per_message
+        self.max_attempts = max_attempts
+        self.max_retry_wait = max_retry_wait
+        # Messages whose failure has already been counted this run
+        self.counted = set()
+
+    @classmethod
+    def from_config(cls, sc, outbox, seen, config):
+        options = config.get("delivery", {})
+        return cls(
+            sc, outbox, seen,
+            properties_per_message = options.get("properties_per_message", 10),
+            max_attempts = options.get("max_attempts", 5),
+        )
+
+    def queue(self, config, properties):
+        "Group properties by channel into messages and put them in the outbox, returning their ids"
+        by_channel = {}
+        for prop in properties.values():
+            channel = prop.slack_channel or config.get("slack_channel") or "openrent"
+            by_channel.setdefault(channel, []).append(prop)
+
+        n, queued = self.properties_per_message, []
+        for channel, props in by_channel.items():
+            for i in range(0, len(props), n):
+                chunk = props[i : i + n]
+                blocks = []
+                for prop in chunk:
+                    if blocks: blocks.append(DIVIDER_BLOCK)
+                    blocks.append(property_description(prop))
+                    # if prop.floorPlanUrl: blocks.append(floorplan(prop.floorPlanUrl))
+                text = "New property found!" if len(chunk) == 1 else f"{len(chunk)} new properties found!"
+                queued.append(self.outbox.add(channel, text, blocks, [p.id for p in chunk]))
+        return queued
+
+    def queue_price_drops(self, config, drops):
+        "Put a message listing properties that have gone down in price in the outbox"
+        if not drops: return
+        n = self.properties_per_message
+        for i in range(0, len(drops), n):
+            chunk = drops[i : i + n]
+            text = "📉 Price reduced!" if len(chunk) == 1 else f"📉 {len(chunk)} prices reduced!"
+            self.outbox.add(config.get("slack_channel") or "openrent", text, [price_drops_description(chunk)], [])
+
+    def post(self, channel, text, blocks):
+        "Post a message, waiting out any rate limiting for as long as slack tells us to"
+        from slack_sdk.errors import SlackApiError
+        while True:
+            try:
+                with metrics.stage("slack_post"):
+                    return self.sc.chat_postMessage(channel = channel, text = text, blocks = blocks)
+            except SlackApiError as e:
+                if e.response.status_code != 429: raise
+                wait = int(e.response.headers.get("Retry-After", 1))
+                if wait > self.max_retry_wait: raise
+                logger.info(f"Rate limited by slack, waiting {wait}s")
+                time.sleep(wait)
+
+    def flush(self, only = None):
+        "Try to send everything in the outbox, or just the messages with ids in only, returns the number of messages sent"
+        from slack_sdk.errors import SlackApiError
+        sent = 0
+        for id_, channel, text, blocks, property_ids, attempts in self.outbox.pending():
+            if only is not None and id_ not in only: continue
+            try:
+                self.post(channel, text, blocks)
+            except SlackApiError as e:
+                # Slack didn't like this message, leave it for next time unless it's failed too often to ever work
+                logger.error(f"Couldn't post {len(property_ids)} properties to {channel}: {e.response.get('error')}")
+                if e.response.status_code != 429 and len(property_ids) > 1:
+                    # It might only be one of them it doesn't like, don't hold the others up
+                    logger.info("Posting them one at a time instead.")
+                    sent += self.flush(only = set(self.split(id_, channel, blocks, property_ids)))
+                    continue
+                if id_ in self.counted: continue
+                if attempts + 1 < self.max_attempts:
+                    self.outbox.failed(id_)
+                    self.counted.add(id_)
+                    continue
+                logger.error(f"Giving up on them after {attempts + 1} attempts.")
+            except Exception as e:
+                # Probably can't reach slack at all, so stop and try everything again next time
+                logger.error(f"Couldn't reach slack, leaving {len(self.outbox.pending())} messages for next time: {e}")
+                break
+            else:
+                sent += 1
+            self.seen.add_many(property_ids)
+            self.outbox.remove(id_)
+        return sent
+
+    def split(self, id_, channel, blocks, property_ids):
+        "Replace a message in the outbox with one for each of its properties, returning their ids"
+        sections = [block for block in blocks if block != DIVIDER_BLOCK]
+        ids = [self.outbox.add(channel, "New property found!", [block], [p]) for block, p in zip(sections, property_ids)]
+        self.outbox.remove(id_)
+        return ids
+
+    def deliver(self, config, properties):
+        "Queue properties then try to send everything in the outbox, including anything left from earlier runs"
+        self.queue(config, properties)
+        return self.flush()
+
+    def deliver_now(self, config, properties):
+        """Queue properties and try to send just their messages, for streaming.
+        Anything older is left for the deliver at the end of the run, so the backlog is only retried once per run."""
+        return self.flush(only = set(self.queue(config, properties)))
+
+
+def open_outbox(config, read_only = False):
+    "Open the outbox, with read_only (for dry runs) not creating it if it isn't there yet"
+    path = config.get("outbox", "data/outbox.sqlite")
+    # Nothing can be queued in an outbox that doesn't exist, an in memory one saves leaving an empty file behind
+    if read_only and not Path(path).exists(): return Outbox(":memory:")
+    return Outbox(path, read_only = read_only)
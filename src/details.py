@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+import json
+
+import logging
+logger = logging.getLogger("")
+
+from db import Database, chunks
+
+
+class DetailStore(Database):
+    """What the OpenRent propertiesbyid API told us about each property and when, kept between runs
+    so we only ask it about properties that are new or whose details have gone stale.
+    Anything that gets its details is normally posted or marked seen in the same run, so this only saves asking again
+    when a property comes back before that's happened, see "Getting more info" in the README."""
+    schema = """
+        CREATE TABLE IF NOT EXISTS details (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS fetched_at_idx ON details (fetched_at);
+    """
+
+    def __init__(self, path, max_age = timedelta(hours = 12), ttl = timedelta(days = 30)):
+        super().__init__(path)
+        self.max_age = max_age
+        if ttl:
+            cutoff = (datetime.now(timezone.utc) - ttl).timestamp()
+            self.execute("DELETE FROM details WHERE fetched_at < ?", (cutoff,))
+
+    def fresh(self, ids):
+        "The stored details of any of ids fetched within max_age, by id"
+        cutoff = (datetime.now(timezone.utc) - self.max_age).timestamp()
+        found = {}
+        for chunk in chunks(list(ids)):
+            rows = self.execute(
+                f"SELECT id, data FROM details WHERE fetched_at >= ? AND id IN ({','.join('?' * len(chunk))})",
+                (cutoff, *chunk),
+            )
+            found.update((id_, json.loads(data)) for id_, data in rows)
+        return found
+
+    def put_many(self, details):
+        "Store a dict of id: details"
+        now = datetime.now(timezone.utc).timestamp()
+        self.executemany(
+            "INSERT OR REPLACE INTO details (id, data, fetched_at) VALUES (?, ?, ?)",
+            [(id_, json.dumps(data), now) for id_, data in details.items()],
+        )
+
+
+def open_detail_store(config):
+    """Open the store of OpenRent property details configured by the optional openrent_details block,
+    or None if it's been turned off with `openrent_details: false`"""
+    options = config.get("openrent_details", {})
+    if options is False: return None
+    options = options or {}
+    return DetailStore(
+        options.get("path", "data/openrent_details.sqlite"),
+        max_age = timedelta(hours = options.get("max_age_hours", 12)),
+        ttl = timedelta(days = options.get("ttl_days", 30)),
+    )
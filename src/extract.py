@@ -0,0 +1,35 @@
+from metrics import metrics
+
+# Pull the contents of a single <script> tag out of a page without building a DOM.
+# The pages we scrape are mostly markup we don't care about, so instead of parsing it all we
+# search the raw bytes for the marker we want and then look either side of it for the enclosing tag.
+
+def find_script(html, marker):
+    """Return the contents of the first <script> tag that contains marker, or None.
+    Works on either str or bytes, returning the same type it was given."""
+    if isinstance(html, bytes):
+        if isinstance(marker, str): marker = marker.encode()
+        open_tag, close_tag, gt = b"<script", b"</script", b">"
+    else:
+        open_tag, close_tag, gt = "<script", "</script", ">"
+
+    i = html.find(marker)
+    while i != -1:
+        start = html.rfind(open_tag, 0, i)
+        # The marker only counts if it comes after the end of an opening <script ...> tag and that script hasn't closed yet
+        if start != -1 and html.rfind(close_tag, start, i) == -1:
+            content_start = html.find(gt, start) + 1
+            if 0 < content_start <= i:
+                end = html.find(close_tag, i)
+                return html[content_start : end if end != -1 else len(html)]
+        i = html.find(marker, i + len(marker))
+    return None
+
+
+def script_text(response, marker):
+    "Find the script tag containing marker in a requests response, decoding just that script rather than the whole page"
+    with metrics.stage("html_parse"):
+        content = find_script(response.content, marker)
+    if content is None:
+        raise ValueError(f"Couldn't find a script containing {marker!r} in {response.url}")
+    return content.decode(response.encoding or "utf-8", errors = "replace")
@@ -0,0 +1,268 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from random import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+logger = logging.getLogger("")
+
+from httpcache import CachingAdapter
+from metrics import metrics
+
+
+class HostBlocked(requests.RequestException):
+    "A host has failed or blocked us too many times in a row, so we've stopped asking it anything for a while"
+
+
+class BlockedPage(requests.HTTPError):
+    "A site answered with a captcha or access denied page rather than what we asked for"
+
+
+# Statuses and bits of page that mean a site has decided we're a bot, rather than that something's broken
+BLOCK_STATUSES = {403, 429}
+# Only markers particular to challenge and access denied pages, a word like captcha turns up in ordinary pages' forms and scripts
+BLOCK_MARKERS = (b"cf-chl", b"challenge-platform", b"<title>access denied", b"<title>just a moment")
+# Block pages are small and say so near the top, so a big page answered with a 200 is taken to be the real thing
+BLOCK_SNIFF = 4096
+BLOCK_PAGE_MAX = 32 * 1024
+
+def is_block_page(r):
+    if r.status_code in BLOCK_STATUSES: return True
+    if "html" not in r.headers.get("Content-Type", "") or len(r.content) > BLOCK_PAGE_MAX: return False
+    # Bytes rather than r.text, which would decode the whole page, guessing its encoding if it doesn't say
+    head = r.content[:BLOCK_SNIFF].lower()
+    return any(marker in head for marker in BLOCK_MARKERS)
+
+
+class HostState:
+    """How many requests we let be in flight to one host, adjusted AIMD style like TCP's congestion window:
+    it grows by about one per round of quick successful responses, and halves when a response is slow or fails.
+    After failure_threshold failures in a row the circuit opens and everything for the host fails straight away
+    with HostBlocked until cooldown seconds have passed, then requests are let through one at a time to try it again."""
+
+    def __init__(self, host, initial = 2, maximum = 8, target_latency = 2, failure_threshold = 5, cooldown = 300):
+        self.host = host
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.failures = 0 # in a row
+        self.open_until = 0
+        self.decreased_at = 0
+        self.condition = threading.Condition()
+
+    def check(self):
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            raise HostBlocked(f"{self.host} keeps failing or blocking us, not asking it anything for another {remaining:.0f}s")
+
+    def acquire(self):
+        "Block until there's a free slot, raising HostBlocked if the circuit is open"
+        with self.condition:
+            while True:
+                self.check()
+                if self.in_flight < int(self.limit): break
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self.condition:
+            self.in_flight -= 1
+            if ok:
+                self.failures = 0
+                if latency <= self.target_latency: self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                else: self.decrease(latency)
+            else:
+                self.failures += 1
+                self.decrease(latency)
+                if self.failures >= self.failure_threshold:
+                    if self.open_until < time.monotonic():
+                        logger.warning(f"{self.failures} failures in a row from {self.host}, leaving it alone for {self.cooldown}s")
+                    self.open_until = time.monotonic() + self.cooldown
+                    # So that once the cooldown's over it's tried again one request at a time
+                    self.limit = 1.0
+            # Wake everyone waiting, either to take the freed slot or to find out the circuit has opened
+            self.condition.notify_all()
+
+    def decrease(self, latency):
+        # The responses to everything already in flight carry the same news, so only back off once per round trip
+        now = time.monotonic()
+        if now - self.decreased_at < latency: return
+        self.decreased_at = now
+        self.limit = max(1.0, self.limit / 2)
+
+
+class HostLimiter:
+    "A HostState for every host we talk to"
+
+    def __init__(self, per_host = 2, max_per_host = 8, target_latency = 2, failure_threshold = 5, cooldown = 300):
+        self.options = dict(
+            initial = per_host, maximum = max(per_host, max_per_host), target_latency = target_latency,
+            failure_threshold = failure_threshold, cooldown = cooldown,
+        )
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def host(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostState(host, **self.options)
+            return self._hosts[host]
+
+    def limit(self, url):
+        "How many requests we'd currently let be in flight to the host that url points at"
+        return int(self.host(urlparse(url).netloc).limit)
+
+
+class TokenBucket:
+    "Allow on average `rate` requests per second, with bursts of up to `burst`"
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size = 10, cache = None):
+    """A requests session with a connection pool big enough to be shared between threads,
+    answering from an httpcache.HTTPCache if we're given one"""
+    session = requests.session()
+    session.hooks["response"].append(metrics.response_hook)
+    if cache is not None:
+        adapter = CachingAdapter(cache, pool_connections = pool_size, pool_maxsize = pool_size)
+    else:
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class Fetcher:
+    """Wraps a session to fetch pages with an adaptive per host concurrency limit, a rate limit and a timeout,
+    retrying failures with backoff and giving up on hosts that keep failing or blocking us.
+    Has the same get() as a session so it can be passed anywhere a session is expected."""
+
+    def __init__(self, session = None, max_workers = 8, per_host = 2, max_per_host = 8, rate = 5, burst = 5, retries = 3, backoff = 0.5,
+                 timeout = 20, target_latency = 2, failure_threshold = 5, cooldown = 300):
+        self.session = session if session is not None else requests
+        self.max_workers = max_workers
+        self.limiter = HostLimiter(per_host, max_per_host, target_latency, failure_threshold, cooldown)
+        self.timeout = timeout
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    @classmethod
+    def from_config(cls, session, config):
+        c = config.get("concurrency", {})
+        return cls(
+            session,
+            max_workers = c.get("detail_workers", 8),
+            per_host = c.get("per_host", 2),
+            max_per_host = c.get("max_per_host", 8),
+            rate = c.get("rate", 5),
+            burst = c.get("burst", 5),
+            retries = c.get("retries", 3),
+            backoff = c.get("backoff", 0.5),
+            timeout = c.get("timeout", 20),
+            target_latency = c.get("target_latency", 2),
+            failure_threshold = c.get("failure_threshold", 5),
+            cooldown = c.get("cooldown", 300),
+        )
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def get(self, url, **kwargs):
+        host = urlparse(url).netloc
+        state = self.limiter.host(host)
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            self.bucket(host).acquire()
+            state.acquire()
+            start = time.perf_counter()
+            try:
+                with metrics.stage("fetch"):
+                    r = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                state.release(time.perf_counter() - start, ok = False)
+                metrics.count("timeouts" if isinstance(e, requests.Timeout) else "connection_errors", host)
+                if attempt == self.retries: raise
+                delay = self.backoff * 2 ** attempt
+                failure = e
+            else:
+                blocked = is_block_page(r)
+                if not blocked and r.status_code not in RETRY_STATUSES:
+                    state.release(time.perf_counter() - start, ok = True)
+                    return r
+                state.release(time.perf_counter() - start, ok = False)
+                if blocked: metrics.count("blocked", host)
+                retry_after = r.headers.get("Retry-After", "")
+                delay = min(float(retry_after), 60) if retry_after.isdigit() else self.backoff * 2 ** attempt
+                failure = f"Block page (HTTP {r.status_code})" if blocked else f"HTTP {r.status_code}"
+
+            if attempt < self.retries:
+                logger.debug(f"{failure} from {url}, retrying in {delay:.1f}s")
+                time.sleep(delay * (1 + random() / 2))
+
+        if blocked: raise BlockedPage(f"{failure} from {url}", response = r)
+        r.raise_for_status()
+        return r
+
+    def fetch_all(self, items, url = lambda item: item, on_error = None):
+        """Fetch url(item) for every item concurrently, yielding (item, response) pairs as they finish
+        so the caller can parse one page while the others are still downloading.
+        Pages that still fail after retrying are logged and skipped, after calling on_error(item, exception) if given."""
+        blocked = set()
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            futures = {pool.submit(self.get, url(item)): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    r = future.result()
+                    r.raise_for_status()
+                except HostBlocked as e:
+                    # Everything else for the host fails the same way, once is enough to say so
+                    host = urlparse(url(item)).netloc
+                    if host not in blocked: logger.warning(f"{e}, skipping the rest of its pages")
+                    blocked.add(host)
+                    if on_error is not None: on_error(item, e)
+                    continue
+                except requests.RequestException as e:
+                    logger.warning(f"Failed to fetch {url(item)}: {e}")
+                    if on_error is not None: on_error(item, e)
+                    continue
+                yield item, r
+
+
+def as_fetcher(session):
+    "Let functions take either a plain session or a Fetcher"
+    return session if isinstance(session, Fetcher) else Fetcher(session)
@@ -0,0 +1,113 @@
+from math import cos, radians
+from pathlib import Path
+import csv
+
+from utils import lazy_import
+np = lazy_import("numpy")
+
+# Geometry for the location rules: distances to points, polygons to search inside, and an index of stations.
+# Everything here works on numpy arrays of coordinates so whole columns of OpenRent results can be checked at once,
+# single properties are just arrays of length one.
+
+EARTH_RADIUS_M = 6_371_000
+METRES_PER_DEGREE = 111_000 # of latitude, and of longitude at the equator
+# Streets aren't straight, walking routes in London come out about this much longer than the distance as the crow flies
+WALKING_FACTOR = 1.3
+STATIONS_PATH = Path(__file__).parent / "stations.csv"
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    "Distance in metres between points on the earth, takes numbers or numpy arrays that broadcast together"
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def coordinates(lat, lon):
+    "Latitudes and longitudes as float arrays, with NaN where they're missing"
+    def as_floats(values):
+        values = np.atleast_1d(np.asarray(values))
+        try: return values.astype(float)
+        except (TypeError, ValueError): return np.array([np.nan if v is None else float(v) for v in values])
+    return as_floats(lat), as_floats(lon)
+
+
+def in_polygon(lat, lon, polygon):
+    "Which points are inside a polygon given as a list of [latitude, longitude] corners, by ray casting"
+    corners = np.asarray(polygon, dtype = float)
+    inside = np.zeros(lat.shape, dtype = bool)
+    for (lat1, lon1), (lat2, lon2) in zip(corners, np.roll(corners, -1, axis = 0)):
+        # Does a ray going east from the point cross this edge?
+        crosses = (lat1 > lat) != (lat2 > lat)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            edge_lon = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        inside ^= crosses & (lon < edge_lon)
+    return inside
+
+
+class StationIndex:
+    "Stations bucketed into a grid so a property only gets measured against the ones in the squares around it"
+
+    def __init__(self, names, lats, lons, cell_degrees = 0.01):
+        self.names = list(names)
+        self.lats = np.asarray(lats, dtype = float)
+        self.lons = np.asarray(lons, dtype = float)
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+        for i, key in enumerate(zip(*self.cell(self.lats, self.lons))):
+            self.cells.setdefault(key, []).append(i)
+
+    @classmethod
+    def from_csv(cls, path = STATIONS_PATH):
+        "Load a csv of stations with name, latitude and longitude columns, lines starting with # are comments"
+        with open(path, newline = "", encoding = "utf-8") as f:
+            rows = list(csv.DictReader(line for line in f if not line.startswith("#")))
+        return cls([r["name"] for r in rows], [float(r["latitude"]) for r in rows], [float(r["longitude"]) for r in rows])
+
+    def __len__(self):
+        return len(self.names)
+
+    def cell(self, lat, lon):
+        return np.floor(lat / self.cell_degrees).astype(int), np.floor(lon / self.cell_degrees).astype(int)
+
+    def nearest(self, lat, lon, max_m):
+        """The distance in metres to the nearest station to each point and that station's index, only looking max_m away.
+        Points without a station that close, or without a location, get inf and -1."""
+        distances = np.full(lat.shape, np.inf)
+        nearest = np.full(lat.shape, -1)
+        located = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+        if not len(located) or not len(self): return distances, nearest
+
+        # How many cells either side to search, they get narrower in longitude away from the equator
+        reach_lat = int(max_m / (self.cell_degrees * METRES_PER_DEGREE)) + 1
+        widest = min(np.abs(lat[located]).max() + self.cell_degrees, 89)
+        reach_lon = int(max_m / (self.cell_degrees * METRES_PER_DEGREE * cos(radians(widest)))) + 1
+
+        # Points in the same cell share the same candidate stations, so measure them together
+        cell_lat, cell_lon = self.cell(lat[located], lon[located])
+        keys, group = np.unique(np.stack([cell_lat, cell_lon], axis = 1), axis = 0, return_inverse = True)
+        group = group.reshape(-1)
+        for k, (c_lat, c_lon) in enumerate(keys):
+            candidates = [i for d_lat in range(-reach_lat, reach_lat + 1) for d_lon in range(-reach_lon, reach_lon + 1)
+                          for i in self.cells.get((c_lat + d_lat, c_lon + d_lon), ())]
+            if not candidates: continue
+            rows = located[group == k]
+            d = haversine_m(lat[rows, None], lon[rows, None], self.lats[None, candidates], self.lons[None, candidates])
+            best = d.argmin(axis = 1)
+            distances[rows] = d[np.arange(len(rows)), best]
+            nearest[rows] = np.asarray(candidates)[best]
+
+        too_far = distances > max_m
+        distances[too_far] = np.inf
+        nearest[too_far] = -1
+        return distances, nearest
+
+
+_station_indexes = {}
+
+def load_stations(path = None):
+    "The station index for a csv, loaded once and shared between searches"
+    path = Path(path or STATIONS_PATH)
+    if path not in _station_indexes:
+        _station_indexes[path] = StationIndex.from_csv(path)
+    return _station_indexes[path]
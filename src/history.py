@@ -0,0 +1,125 @@
+from collections.abc import Mapping
+from datetime import datetime, timezone
+import json
+import zlib
+
+import logging
+logger = logging.getLogger("")
+
+from db import Database, chunks
+
+# Everything we've ever parsed, kept so we can look back at what was on the market and follow prices over time.
+# A property gets one row in properties, updated each time we see it, and a row in prices only when its price changes,
+# so a flat that sits on the market for months at the same price only costs one price row.
+
+
+def json_default(value):
+    "Make the numpy values and datetimes that end up in rawData serialisable"
+    if hasattr(value, "item"): return value.item() # numpy scalars
+    if isinstance(value, datetime): return value.isoformat()
+    if isinstance(value, Mapping): return dict(value) # utils.RawData
+    raise TypeError(f"Can't serialise {type(value).__name__}")
+
+
+class History(Database):
+    "Every property we've parsed with its raw data, and every price we've seen it listed at"
+    schema = """
+        CREATE TABLE IF NOT EXISTS properties (
+            id TEXT PRIMARY KEY,
+            agent TEXT,
+            title TEXT,
+            url TEXT,
+            bedrooms INTEGER,
+            latitude REAL,
+            longitude REAL,
+            listed_at REAL,
+            price REAL,
+            matched INTEGER NOT NULL DEFAULT 0,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            raw BLOB
+        );
+        CREATE INDEX IF NOT EXISTS agent_idx ON properties (agent);
+        CREATE INDEX IF NOT EXISTS listed_at_idx ON properties (listed_at);
+        CREATE INDEX IF NOT EXISTS location_idx ON properties (latitude, longitude);
+        CREATE TABLE IF NOT EXISTS prices (
+            id TEXT NOT NULL,
+            observed_at REAL NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (id, observed_at)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS observed_at_idx ON prices (observed_at);
+    """
+
+    def observe(self, prices):
+        """Record a dict of id: price for everything a run's searches returned, including the ones we skipped,
+        adding a price row for each property that's new or whose price has changed"""
+        now = datetime.now(timezone.utc).timestamp()
+        prices = {id_ : float(price) for id_, price in prices.items() if price is not None}
+        last = {}
+        for chunk in chunks(list(prices)):
+            last.update(self.execute(f"SELECT id, price FROM properties WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+
+        changed = [(id_, now, price) for id_, price in prices.items() if last.get(id_) != price]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO properties (id, first_seen, last_seen) VALUES (?, ?, ?)",
+                [(id_, now, now) for id_ in prices if id_ not in last],
+            )
+            self.conn.executemany("UPDATE properties SET price = ?, last_seen = ? WHERE id = ?", [(p, now, id_) for id_, p in prices.items()])
+            self.conn.executemany("INSERT OR REPLACE INTO prices (id, observed_at, price) VALUES (?, ?, ?)", changed)
+        return len(changed)
+
+    def record(self, properties, matched = ()):
+        """Store the details of some parsed properties, matched is the ids of the ones that passed a search's rules.
+        Prices are left to observe()."""
+        now = datetime.now(timezone.utc).timestamp()
+        matched = set(matched)
+        rows = [
+            (p.id, p.agent, p.title, p.url,
+             None if p.bedrooms is None else int(p.bedrooms),
+             None if p.latitude is None else float(p.latitude),
+             None if p.longitude is None else float(p.longitude),
+             p.listedAt.timestamp() if p.listedAt else None,
+             int(p.id in matched), now, now,
+             zlib.compress(json.dumps(p.rawData, default = json_default).encode()) if p.rawData else None)
+            for p in properties
+        ]
+        self.executemany(
+            """INSERT INTO properties (id, agent, title, url, bedrooms, latitude, longitude, listed_at, matched, first_seen, last_seen, raw)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET
+                   agent = excluded.agent, title = excluded.title, url = excluded.url, bedrooms = excluded.bedrooms,
+                   latitude = excluded.latitude, longitude = excluded.longitude, listed_at = excluded.listed_at,
+                   matched = max(matched, excluded.matched), last_seen = excluded.last_seen, raw = excluded.raw""",
+            rows,
+        )
+
+    def raw_data(self, id_):
+        rows = self.execute("SELECT raw FROM properties WHERE id = ?", (id_,))
+        return json.loads(zlib.decompress(rows[0][0])) if rows and rows[0][0] else None
+
+    def price_history(self, id_):
+        "(time, price) for every price change we've seen for a property"
+        return [(datetime.fromtimestamp(t, timezone.utc), price)
+                for t, price in self.execute("SELECT observed_at, price FROM prices WHERE id = ? ORDER BY observed_at", (id_,))]
+
+    def price_drops(self, since):
+        """(id, title, url, old price, new price) for every property that matched one of our searches
+        and has gone down in price since the timestamp since"""
+        return self.execute(
+            """SELECT p.id, p.title, p.url, c.previous, c.price FROM (
+                   SELECT id, price, observed_at, lag(price) OVER (PARTITION BY id ORDER BY observed_at) AS previous
+                   FROM prices WHERE id IN (SELECT id FROM prices WHERE observed_at >= ?)
+               ) AS c JOIN properties AS p ON p.id = c.id
+               WHERE c.observed_at >= ? AND c.price < c.previous AND p.matched
+               ORDER BY p.id""",
+            (since, since),
+        )
+
+
+def open_history(config):
+    "Open the listings history configured by the optional history block, or None if there isn't one"
+    options = config.get("history")
+    if not options: return None
+    return History(options.get("path", "data/history.sqlite"))
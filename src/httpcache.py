@@ -0,0 +1,169 @@
+from collections import Counter
+from datetime import datetime, timezone
+import json
+import re
+import threading
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import logging
+logger = logging.getLogger("")
+
+from db import Database
+
+
+TRANSFER_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+class HTTPCache(Database):
+    "Responses stored in sqlite, compressed, with the validators needed to make conditional requests for them"
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            fetched_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS last_used_idx ON responses (last_used);
+    """
+
+    def __init__(self, path, max_size_mb = 200, default_ttl = 0, ttls = None):
+        super().__init__(path)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.default_ttl = default_ttl
+        # url regex -> seconds a response can be reused for without asking the server
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or {}).items()]
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, what):
+        with self.stats_lock:
+            self.stats[what] += 1
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url): return ttl
+        return self.default_ttl
+
+    def get(self, url):
+        rows = self.execute("SELECT status, headers, body, fetched_at FROM responses WHERE url = ?", (url,))
+        if not rows: return None
+        status, headers, body, fetched_at = rows[0]
+        return status, json.loads(headers), zlib.decompress(body), fetched_at
+
+    def put(self, url, response):
+        now = datetime.now(timezone.utc).timestamp()
+        # The body we store is already decoded so the transfer headers don't apply to it any more
+        headers = {k : v for k, v in response.headers.items() if k.lower() not in TRANSFER_HEADERS}
+        self.execute(
+            "INSERT OR REPLACE INTO responses (url, status, headers, body, fetched_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (url, response.status_code, json.dumps(headers), zlib.compress(response.content), now, now),
+        )
+
+    def touch(self, url, revalidated = False):
+        "Mark a response as just used, and if the server told us it's still good, as just fetched too"
+        now = datetime.now(timezone.utc).timestamp()
+        if revalidated:
+            self.execute("UPDATE responses SET fetched_at = ?, last_used = ? WHERE url = ?", (now, now, url))
+        else:
+            self.execute("UPDATE responses SET last_used = ? WHERE url = ?", (now, url))
+
+    def evict(self):
+        "Throw away the least recently used responses until the cache fits in max_size"
+        with self.lock:
+            total = self.conn.execute("SELECT coalesce(sum(length(body) + length(headers)), 0) FROM responses").fetchone()[0]
+            if total <= self.max_size: return
+            rows = self.conn.execute("SELECT url, length(body) + length(headers) FROM responses ORDER BY last_used").fetchall()
+            evicted = []
+            for url, size in rows:
+                if total <= self.max_size: break
+                evicted.append((url,))
+                total -= size
+            with self.conn:
+                self.conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+        with self.stats_lock:
+            self.stats["evicted"] += len(evicted)
+
+    def summary(self):
+        s = self.stats
+        lookups = s["hit"] + s["revalidated"] + s["miss"]
+        hit_rate = (s["hit"] + s["revalidated"]) / lookups if lookups else 0
+        return (f"HTTP cache: {s['hit']} fresh hits, {s['revalidated']} revalidated, {s['miss']} misses "
+                f"({hit_rate:.0%} hit rate), {s['evicted']} evicted")
+
+    def close(self):
+        self.evict()
+        super().close()
+
+
+class CachingAdapter(HTTPAdapter):
+    """Transport adapter that answers GETs from an HTTPCache.
+    Responses younger than their url's TTL are returned without touching the network, older ones are revalidated
+    with If-None-Match/If-Modified-Since and reused if the server says they haven't changed."""
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        url = request.url
+        ttl = self.cache.ttl(url)
+        cached = self.cache.get(url)
+        if cached:
+            status, headers, body, fetched_at = cached
+            if datetime.now(timezone.utc).timestamp() - fetched_at < ttl:
+                self.cache.count("hit")
+                self.cache.touch(url)
+                return self.cached_response(request, status, headers, body)
+            headers = CaseInsensitiveDict(headers)
+            if "ETag" in headers: request.headers["If-None-Match"] = headers["ETag"]
+            if "Last-Modified" in headers: request.headers["If-Modified-Since"] = headers["Last-Modified"]
+
+        r = super().send(request, **kwargs)
+
+        if cached and r.status_code == 304:
+            self.cache.count("revalidated")
+            self.cache.touch(url, revalidated = True)
+            return self.cached_response(request, status, headers, body, revalidated = True)
+
+        self.cache.count("miss")
+        # fetch imports us, so this has to wait until it's needed
+        from fetch import is_block_page
+        # Only worth keeping if we can reuse it outright or revalidate it later. Never a block page that came with a 200,
+        # or retrying would just get it back from here
+        if r.status_code == 200 and (ttl > 0 or "ETag" in r.headers or "Last-Modified" in r.headers) and not is_block_page(r):
+            self.cache.put(url, r)
+        return r
+
+    def cached_response(self, request, status, headers, body, revalidated = False):
+        r = requests.Response()
+        r.status_code = status
+        r.headers = CaseInsensitiveDict(headers)
+        r._content = body
+        r.encoding = get_encoding_from_headers(r.headers)
+        r.url = request.url
+        r.request = request
+        r.reason = "OK"
+        r.from_cache = True
+        r.revalidated = revalidated # the server was asked, and said it hadn't changed
+        return r
+
+
+def open_http_cache(config):
+    "Open the response cache configured by the optional http_cache block, or None if there isn't one"
+    options = config.get("http_cache")
+    if not options: return None
+    return HTTPCache(
+        options.get("path", "data/http_cache.sqlite"),
+        max_size_mb = options.get("max_size_mb", 200),
+        default_ttl = options.get("default_ttl", 0),
+        ttls = options.get("ttls"),
+    )
@@ -0,0 +1,38 @@
+import re
+
+
+class KeywordMatcher:
+    """Finds which of a list of keywords, and of a list of terms to exclude, appear in some text in one pass.
+    All the terms are compiled into a single case insensitive regex. It's wrapped in a lookahead so that it matches at
+    every position and overlapping terms aren't missed, with longer terms first so each position reports its longest match.
+    Shorter terms inside a longer match (e.g. "garden" in "garden flat") are picked up from a table built as they're seen."""
+
+    def __init__(self, keywords = (), exclude = (), whole_words = False):
+        self.keywords = list(keywords)
+        self.exclude = list(exclude)
+        self.whole_words = whole_words
+        terms = sorted({t.lower() for t in self.keywords + self.exclude}, key = len, reverse = True)
+        self.term_patterns = {t : re.compile(self.pattern(t), re.IGNORECASE) for t in terms}
+        self.regex = re.compile(
+            "(?=(" + "|".join(self.pattern(t) for t in terms) + "))", re.IGNORECASE
+        ) if terms else None
+        self._contained = {} # matched text -> every term that it contains
+
+    def pattern(self, term):
+        return rf"\b{re.escape(term)}\b" if self.whole_words else re.escape(term)
+
+    def terms_in(self, matched):
+        if matched not in self._contained:
+            self._contained[matched] = {t for t, p in self.term_patterns.items() if p.search(matched)}
+        return self._contained[matched]
+
+    def find(self, text):
+        "Return the keywords and the excluded terms that appear in text, each in the order they were given"
+        if not text or self.regex is None: return [], []
+        found = set()
+        for m in self.regex.finditer(text):
+            found |= self.terms_in(m.group(1).lower())
+        return (
+            [k for k in self.keywords if k.lower() in found],
+            [e for e in self.exclude if e.lower() in found],
+        )
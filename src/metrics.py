@@ -0,0 +1,186 @@
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+import json
+import threading
+import time
+
+import logging
+logger = logging.getLogger("")
+
+# Where each run spends its time. Code times itself with
+#
+#   with metrics.stage("filter"):
+#       ...
+#
+# against the shared `metrics` below, and sessions from fetch.make_session count requests, bytes and cache hits per host.
+# At the end of a run the numbers can be written out as JSON or Prometheus text and summarised for the debug message.
+
+PREFIX = "rentals_bot"
+# Upper bounds of the latency histogram buckets in seconds, like Prometheus' defaults with a few longer ones for slow stages
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        "Estimate a quantile as the upper bound of the bucket it falls in"
+        if not self.count: return 0.0
+        target, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target: return min(bound, self.max)
+        return self.max
+
+    def merge(self, data):
+        "Add in another histogram with the same buckets, given as its to_dict()"
+        for i, bound in enumerate(self.buckets):
+            self.counts[i] += data["buckets"].get(str(bound), 0)
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+
+    def to_dict(self):
+        return {
+            "count": self.count, "sum": self.sum, "max": self.max, "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+            "buckets": {str(bound) : n for bound, n in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics:
+    "Latency histograms per stage and counters per host, safe to update from any thread"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = Counter() # (name, host) -> count
+            self.started = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages: self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def count(self, name, host = "", value = 1):
+        with self.lock:
+            self.counters[name, host] += value
+
+    def merge(self, data):
+        "Add in the numbers from another process' to_dict(), like a worker's in tenants.run_tenants"
+        with self.lock:
+            for name, h in data["stages"].items():
+                if name not in self.stages: self.stages[name] = Histogram()
+                self.stages[name].merge(h)
+            for host, counts in data["hosts"].items():
+                for name, n in counts.items():
+                    # The hit rate is worked out again from the merged hits and misses
+                    if name != "cache_hit_rate": self.counters[name, "" if host == "all" else host] += n
+
+    def response_hook(self, r, *args, **kwargs):
+        "A requests response hook that counts requests, bytes and cache hits per host"
+        host = urlparse(r.url).netloc
+        if getattr(r, "from_cache", False):
+            self.count("cache_hits", host)
+            if r.revalidated: self.count("requests", host)
+        else:
+            self.count("requests", host)
+            self.count(f"status_{r.status_code // 100}xx", host)
+            # Not streaming, so the body has to be read anyway
+            self.count("bytes", host, len(r.content))
+            # Only count misses when there's a cache to miss, httpcache.CachingAdapter has one
+            if hasattr(getattr(r, "connection", None), "cache"): self.count("cache_misses", host)
+
+    def to_dict(self):
+        with self.lock:
+            hosts = {}
+            for (name, host), n in self.counters.items():
+                hosts.setdefault(host or "all", {})[name] = n
+            for counts in hosts.values():
+                lookups = counts.get("cache_hits", 0) + counts.get("cache_misses", 0)
+                if lookups: counts["cache_hit_rate"] = counts.get("cache_hits", 0) / lookups
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "stages": {name : h.to_dict() for name, h in self.stages.items()},
+                "hosts": hosts,
+            }
+
+    def to_prometheus(self):
+        "The metrics in the Prometheus text exposition format"
+        with self.lock:
+            lines = [f"# TYPE {PREFIX}_stage_seconds histogram"]
+            for name, h in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                for (n, host), value in sorted(self.counters.items()):
+                    if n == name: lines.append(f'{PREFIX}_{name}_total{{host="{host}"}} {value}')
+            return "\n".join(lines) + "\n"
+
+    def summary(self):
+        "A few lines saying where the time went, for the debug message"
+        data = self.to_dict()
+        stages = sorted(data["stages"].items(), key = lambda kv: -kv[1]["sum"])
+        lines = [f"Took {data['duration']:.1f}s. " + ", ".join(f"{name} {h['sum']:.2f}s/{h['count']} (p95 {h['p95'] * 1000:.0f}ms)" for name, h in stages)]
+        for host, counts in sorted(data["hosts"].items()):
+            line = f"{host}: {counts.get('requests', 0)} requests, {counts.get('bytes', 0) / 1024:.0f} kB"
+            if "cache_hit_rate" in counts: line += f", {counts['cache_hit_rate']:.0%} cache hits"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def write(self, json_path = None, prometheus_path = None):
+        for path, text in ((json_path, lambda: json.dumps(self.to_dict(), indent = 1)), (prometheus_path, self.to_prometheus)):
+            if not path: continue
+            path = Path(path)
+            path.parent.mkdir(parents = True, exist_ok = True)
+            # Write then rename so whatever is scraping the file never sees half of it
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            tmp.write_text(text())
+            tmp.replace(path)
+
+    def write_from_config(self, config):
+        "Write the files named in the optional metrics block"
+        options = config.get("metrics")
+        if not options: return
+        try:
+            self.write(options.get("json_path"), options.get("prometheus_path"))
+        except OSError as e:
+            logger.error(f"Couldn't write metrics: {e}")
+
+
+# Shared by everything in the process, like the logger
+metrics = Metrics()
@@ -1,9 +1,9 @@
-from bs4 import BeautifulSoup
 import re
-import numpy as np
+from urllib.parse import urlencode
 import rapidjson
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from dataclasses import dataclass, field
+from typing import Any, ClassVar
 import requests
 from collections import Counter
 
@@ -11,7 +11,13 @@ import logging, logging.handlers
 logger = logging.getLogger("")
 logger.setLevel(logging.INFO)
 
-from utils import Property, random_chunk, pairs
+from functools import partial
+
+from utils import Property, RawData, already_have, random_chunk, fixed_chunk, pairs, lazy_import
+np = lazy_import("numpy")
+from fetch import as_fetcher
+from extract import script_text
+from metrics import metrics
 
 openrent_keymap = {
     "PROPERTYIDS" : "id",
@@ -39,13 +45,24 @@ def parse_js_list(s):
     "Parse the list from a js var name = [...] statement that might have line breaks etc"
     return rapidjson.loads(s.replace('\n', '').replace("'", '"'), parse_mode = rapidjson.PM_TRAILING_COMMAS | rapidjson.PM_COMMENTS)
 
+MAX_IDS_PER_REQUEST = 20 # propertiesbyid API limit
+
+def properties_by_id_url(ids):
+    "The url of the unofficial API that gives property data by id"
+    assert len(ids) <= MAX_IDS_PER_REQUEST
+    endpoint = "https://www.openrent.co.uk/search/propertiesbyid?"
+    return endpoint + urlencode([('ids', i.split(":")[1]) for i in ids])
+
 def get_properties_by_id(ids, session = None):
     "Access an unoficial API to get property data by id"
     s = session if session else requests
-    assert len(ids) < 20 # API limit
-    endpoint = "https://www.openrent.co.uk/search/propertiesbyid?"
-    json = s.get(endpoint, params = [('ids', i.split(":")[1]) for i in ids]).json()
-    return json
+    r = s.get(properties_by_id_url(ids))
+    r.raise_for_status()
+    return r.json()
+
+def row(columns, i):
+    "Row i of some columns as a dict"
+    return {name : data[i] for name, data in columns.items()}
 
 def make_link(property_id):
     "Construct a human usable link the a property"
@@ -56,34 +73,78 @@ class OpenRentSearch:
     name: str
     url: str
     properties: dict = field(default_factory = dict)
-    
-    def make_request(self, session = None):
+    # In columnar mode the results are left as arrays in self.columns after make_request so they can be
+    # filtered with filter_columns, and Property objects are only built by materialise() for what's left.
+    columnar: bool = False
+    columns: dict = field(default_factory = dict, repr = False)
+    # A details.DetailStore, so more_info only asks the API about properties that are new or stale
+    details: Any = field(default = None, repr = False)
+    # Ask the API for randomly sized batches of ids rather than full ones, so our requests look less alike
+    random_chunks: bool = False
+    # The price of every result, including the ones we skip, so history.History can follow prices
+    prices: dict = field(default_factory = dict, repr = False)
+    # How many properties more_info can get details for in one request, pipeline.py batches them up to this
+    details_batch: ClassVar[int] = MAX_IDS_PER_REQUEST
+    # Set by more_info, like RightmoveSearch's, though the API doesn't tell us when a listing has been taken down
+    gone: set = field(default_factory = set, repr = False)
+    broken: set = field(default_factory = set, repr = False)
+
+    def make_request(self, session = None, seen = None, shared = None):
+        """Run the search. seen and shared are optional functions that take a list of ids and return the ones
+        we've seen before and the ones another search has already parsed this run, see utils.already_have.
+        Both are dropped before we spend any time building Property objects for them."""
         if session is None: session = requests
         r = session.get(self.url)
-        soup = BeautifulSoup(r.text, 'html.parser')
+        r.raise_for_status()
 
         # find the script tag that contains the data we want
         # the criteria I'm using is that it has a line that read "var PROPERTYIDS =  ..."
         # This is how we avoid having to scroll the page to get all the properties
-        script_content = soup.find(lambda tag:tag.name=="script" and "PROPERTYIDS" in tag.text).text
+        script_content = script_text(r, "PROPERTYIDS")
 
         #pull out all the var name = [...] lines from the script using a regex
         variable_data_pairs = re.findall(r"var\s(\S+)\s?=\s?(\[[^\]]*\])", script_content)
 
         #parse that into a dictionary
-        properties_arrays = {openrent_keymap.get(key, key) : np.array(parse_js_list(data)) for key, data in variable_data_pairs}
+        with metrics.stage("json_decode"):
+            properties_arrays = {openrent_keymap.get(key, key) : np.array(parse_js_list(data)) for key, data in variable_data_pairs}
 
-        # Add the data parsed from the script to a properties[property_id] = {key : data about property} object
         ids = properties_arrays['id']
-        logger.info(f"Search {self.name} returned {len(ids)} results")
+        old, elsewhere = already_have([f"openrent:{i}" for i in ids], seen, shared)
+        skipped = old | elsewhere
+        logger.info(f"Search {self.name} returned {len(ids)} results, skipping {len(skipped)}")
+        self.prices = dict(zip((f"openrent:{i}" for i in ids), properties_arrays['price'].astype(float)))
+
+        # Keep the per property arrays as columns, minus the rows we're skipping
+        keep = np.array([f"openrent:{i}" not in skipped for i in ids], dtype = bool)
+        self.columns = {name : data[keep] for name, data in properties_arrays.items() if len(data) == len(ids)}
+
+        # Turn the relative times into timestamps so they can be compared against dates in filters
+        now = datetime.now(timezone.utc).timestamp()
+        self.columns['availableFrom'] = now + self.columns['availableFrom'].astype(float) * 24 * 60 * 60
+        self.columns['listedAt'] = now - self.columns['hoursLive'].astype(float) * 60 * 60
+        self.properties = {}
+        if not self.columnar: self.materialise()
+        return self
+
+    def filter_columns(self, mask_func):
+        """Filter the rows of self.columns with a function that takes the columns and returns
+        a boolean array of rows to keep and a Counter of reasons"""
+        keep, reasons = mask_func(self.columns)
+        self.columns = {name : data[keep] for name, data in self.columns.items()}
+        return reasons
 
+    def materialise(self):
+        "Turn the rows in self.columns into Property objects"
         logger.debug(f"Parsing the results")
+        columns = self.columns
         properties = {}
-        for i, id_ in enumerate(ids):
-            prop = Property(**{name : data[i] for name, data in properties_arrays.items() if name in openrent_keymap.values()})
-            prop.rawData = {name : data[i] for name, data in properties_arrays.items()}
-            prop.availableFrom = datetime.now(timezone.utc) + timedelta(days = int(prop.availableFrom))
-            prop.listedAt = datetime.now(timezone.utc) - timedelta(hours = int(properties_arrays['hoursLive'][i]))
+        for i in range(len(columns['id'])):
+            prop = Property(**{name : data[i] for name, data in columns.items() if name in openrent_keymap.values()})
+            # Only pulled out of the columns if something asks for it
+            prop.rawData = RawData(partial(row, columns, i))
+            prop.availableFrom = datetime.fromtimestamp(columns['availableFrom'][i], timezone.utc)
+            prop.listedAt = datetime.fromtimestamp(columns['listedAt'][i], timezone.utc)
             prop.url = make_link(prop.id)
             prop.id = f"openrent:{prop.id}"
             prop.agent = "openrent"
@@ -106,24 +167,55 @@ class OpenRentSearch:
         return self
 
     def more_info(self, session = None):
-        "Use an undocumented openrent api to get extra details about the properties"
-        # iterate over the properties and grab random numbers of them 
+        """Use an undocumented openrent api to get extra details about the properties, returning the ids of the ones we got.
+        The ones the API answered about without giving us their details end up in self.broken."""
         logger.debug(f"Pulling more data about the results from the openrent API")
-        if session is None: session = requests
-        for chunk in random_chunk(self.properties.keys()):
-            data = get_properties_by_id(chunk, session = session)
-            for d in data: 
-                p = self.properties[f"openrent:{d['id']}"]
-                p.rawData.update(d)
-                p.title = d["title"]
-                p.description = d["description"]
-                p.letAgreed = d["letAgreed"]
-                p.imgUrl = 'http:' + d['imageUrl']
-    
+        fetcher = as_fetcher(session)
+        self.gone, self.broken = set(), set()
+        ids = list(self.properties.keys())
+        stored = self.details.fresh(ids) if self.details is not None else {}
+        for id_, d in stored.items(): self.add_details(self.properties[id_], d)
+
+        missing = [i for i in ids if i not in stored]
+        logger.info(f"{self.name}: already have details for {len(stored)} properties, fetching {len(missing)}")
+        if self.random_chunks:
+            chunks = list(random_chunk(missing))
+        else:
+            chunks = list(fixed_chunk(missing, MAX_IDS_PER_REQUEST))
+
+        fetched = {}
+        for chunk, r in fetcher.fetch_all(chunks, url = properties_by_id_url):
+            with metrics.stage("json_decode"):
+                data = r.json()
+            for d in data:
+                id_ = f"openrent:{d.get('id')}"
+                if id_ not in self.properties: continue
+                try:
+                    self.add_details(self.properties[id_], d)
+                except (KeyError, TypeError) as e:
+                    logger.warning(f"Couldn't read the details of {id_}, skipping it: {e!r}")
+                    continue
+                fetched[id_] = d
+            # The API leaves out anything it won't tell us about rather than saying why
+            self.broken.update(i for i in chunk if i not in fetched)
+        if self.details is not None and fetched: self.details.put_many(fetched)
+        return stored.keys() | fetched.keys()
+
+    def add_details(self, p, d):
+        "Fill in a property from its propertiesbyid result"
+        p.rawData.update(d)
+        p.title = d["title"]
+        p.description = d["description"]
+        p.letAgreed = d["letAgreed"]
+        p.imgUrl = 'http:' + d['imageUrl']
+
     def even_more_info(self, session = None):
-        for id, p in self.properties.items():
-            r = requests.get(p.url)
-            soup = BeautifulSoup(r.content, 'html.parser')
+        "Scrape each property's page for the few details the API doesn't give us"
+        from bs4 import BeautifulSoup
+        fetcher = as_fetcher(session)
+        for p, r in fetcher.fetch_all(self.properties.values(), url = lambda p: p.url):
+            with metrics.stage("html_parse"):
+                soup = BeautifulSoup(r.content, 'html.parser')
 
             try:
                 stats_table_cells = soup.select('table.intro-stats td')
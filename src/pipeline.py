@@ -0,0 +1,205 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from queue import Queue, Empty
+from urllib.parse import urlparse
+import threading
+import time
+
+import requests
+
+import logging
+logger = logging.getLogger("")
+
+from metrics import metrics
+from scrape import try_find_candidates, log_reasons, give_up_on
+
+# The streaming version of scrape.run_searches, used when streaming is set in config.
+# run_searches waits for every search before enriching anything, and for everything to be enriched before anything
+# gets posted, so the first alert comes as late as the slowest search. Here each property goes
+#
+#   search (parse, filter, seen check) -> enrich -> filter again -> dedup -> deliver
+#
+# on its own as soon as the stage before is done with it. The queues between stages are bounded, so when slack or a
+# site is slow the stages feeding it wait rather than piling up work in memory.
+# Parsing, filtering and the seen check still happen a search page at a time since they work on whole columns,
+# and OpenRent details are asked for in batches of up to 20, but only waiting `linger` seconds to fill one.
+
+DONE = object() # put on a queue to say nothing else is coming
+
+
+class Pipeline:
+    def __init__(self, searches, rules, config, fetcher, already_seen, registry, listings = None, deliver = None):
+        concurrency = config.get("concurrency", {})
+        self.searches = searches
+        self.rules = dict(zip((s.name for s in searches), rules))
+        self.order = {s.name : i for i, s in enumerate(searches)}
+        self.fetcher = fetcher
+        self.already_seen = already_seen
+        self.registry = registry
+        self.listings = listings
+        self.deliver = deliver
+        self.max_workers = concurrency.get("max_workers", 4)
+        self.enrich_workers = concurrency.get("enrich_workers", 4)
+        self.queue_size = concurrency.get("queue_size", 100)
+        self.linger = concurrency.get("linger", 0.2)
+        delivery = config.get("delivery", {})
+        self.per_message = delivery.get("properties_per_message", 10)
+        self.post_linger = delivery.get("linger", 2)
+        self.config = config
+
+        self.lock = threading.Lock()
+        # id -> the searches that found it, a property is enriched once however many searches find it
+        self.claims = {}
+        # id -> the enriched property, once it's been through enrich, and how many of its claims have been checked
+        self.enriched = {}
+        self.checked = {}
+        self.deciding = set()
+        self.sent = set()
+        self.reasons = {s.name : Counter() for s in searches}
+        self.kept = Counter()
+        self.enrich_queues = {kind : Queue(self.queue_size) for kind in {type(s) for s in searches}}
+        self.ready = Queue(self.queue_size)
+        # Anything unexpected that went wrong in a worker thread, raised again once everything's stopped
+        self.errors = []
+
+    def search(self, search):
+        "Run a search and send each of its candidates on to be enriched"
+        search = try_find_candidates(search, self.rules[search.name], self.fetcher, self.already_seen, self.registry)
+        for prop in search.properties.values():
+            with self.lock:
+                first = prop.id not in self.claims
+                self.claims.setdefault(prop.id, []).append(search)
+                late = self.enriched.get(prop.id)
+            if first: self.enrich_queues[type(search)].put((search, prop))
+            # Found after it was already enriched, it still needs checking against this search's rules
+            elif late is not None: self.decide(late)
+
+    def run_searches(self):
+        try:
+            with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+                for future in [pool.submit(self.search, search) for search in self.searches]:
+                    try: future.result()
+                    except Exception as e: self.errors.append(e)
+        finally:
+            for q in self.enrich_queues.values():
+                for _ in range(self.enrich_workers): q.put(DONE)
+
+    def batches(self, q, size, linger):
+        "Lists of up to size items from q, not waiting more than linger seconds for the rest of a batch once the first arrives"
+        while True:
+            item = q.get()
+            if item is DONE: return
+            batch = [item]
+            deadline = time.monotonic() + linger
+            while len(batch) < size:
+                try: item = q.get(timeout = max(0, deadline - time.monotonic()))
+                except Empty: break
+                if item is DONE:
+                    yield batch
+                    return
+                batch.append(item)
+            yield batch
+
+    def enrich(self, kind):
+        for batch in self.batches(self.enrich_queues[kind], kind.details_batch, self.linger):
+            # A copy of the first search, so more_info keeps its settings but only looks at this batch
+            search = replace(batch[0][0], name = "stream", properties = {p.id : p for _, p in batch})
+            with metrics.stage("enrich"):
+                try:
+                    got_info = search.more_info(self.fetcher)
+                except (requests.RequestException, ValueError) as e:
+                    logger.error(f"Couldn't get extra info from {urlparse(search.url).netloc}: {e}")
+                    got_info = set()
+                except Exception as e:
+                    # Keep taking batches, or the searches would block on a full queue
+                    self.errors.append(e)
+                    continue
+            # Like run_searches, anything we couldn't get the extra info for is left for next run
+            missing = [prop.id for _, prop in batch if prop.id not in got_info]
+            if missing: logger.warning(f"Couldn't get extra info for {', '.join(missing)}, leaving them for next time.")
+            give_up_on(self.already_seen, search.gone, search.broken, self.config)
+            for _, prop in batch:
+                if prop.id in got_info: self.decide(prop)
+
+    def decide(self, prop):
+        """Check an enriched property against the rules of each search that found it, in config order.
+        Searches that find it later are checked when they do, so it can still be kept after everyone before rejected it."""
+        with self.lock:
+            # Whoever's already deciding it will pick up any new claims before they stop
+            if prop.id in self.deciding: return
+            self.deciding.add(prop.id)
+            self.enriched[prop.id] = prop
+        while True:
+            with self.lock:
+                checked = self.checked.get(prop.id, 0)
+                searches = self.claims[prop.id][checked:]
+                if not searches:
+                    self.deciding.discard(prop.id)
+                    return
+                self.checked[prop.id] = checked + len(searches)
+            keeper = None
+            with metrics.stage("filter"):
+                for search in sorted(searches, key = lambda s: self.order[s.name]):
+                    keep, reason = self.rules[search.name](prop, verbose = True)
+                    with self.lock: self.reasons[search.name][reason] += 1
+                    if not keep: continue
+                    # Like run_searches, it gets the keywords from the last search that kept it
+                    keeper, keywords = search, prop.keywords
+                    with self.lock: self.kept[search.name] += 1
+            if keeper is None: continue
+            with self.lock:
+                sent = prop.id in self.sent
+                self.sent.add(prop.id)
+            if not sent:
+                prop.keywords = keywords
+                self.ready.put(prop)
+
+    def run(self):
+        "Run everything, delivering properties as they come out the end, and return the ones that made it"
+        started = time.perf_counter()
+        workers = [threading.Thread(target = self.run_searches, name = "searches", daemon = True)]
+        workers += [
+            threading.Thread(target = self.enrich, args = (kind,), name = f"enrich-{kind.__name__}-{i}", daemon = True)
+            for kind in self.enrich_queues for i in range(self.enrich_workers)
+        ]
+        for worker in workers: worker.start()
+        def finish():
+            for worker in workers: worker.join()
+            self.ready.put(DONE)
+        threading.Thread(target = finish, name = "finish", daemon = True).start()
+
+        all_properties, duplicates = {}, []
+        # Give properties that come out close together a moment to make up a message rather than posting each alone
+        for batch in self.batches(self.ready, self.per_message, self.post_linger):
+            batch = {prop.id : prop for prop in batch}
+            if self.listings is not None:
+                with metrics.stage("dedup"):
+                    batch, dups = self.listings.drop_duplicates(batch)
+                duplicates += dups
+            if not batch: continue
+            if not all_properties:
+                metrics.observe("first_property", time.perf_counter() - started)
+                logger.info(f"First new property ready after {time.perf_counter() - started:.1f}s")
+            all_properties.update(batch)
+            if self.deliver is not None:
+                with metrics.stage("deliver"):
+                    self.deliver(batch)
+
+        for search in self.searches:
+            logger.info(f"{search.name}: {self.kept[search.name]} of the results match our criteria after getting extra info.")
+            log_reasons(self.reasons[search.name])
+        if self.errors: raise self.errors[0]
+        # Same as run_searches, remember the ones that failed so we don't fetch their details again next time.
+        # Only now every search is done can we tell nothing else was going to keep them.
+        self.already_seen.add_many(self.enriched.keys() - self.sent)
+        if duplicates:
+            logger.info(f"{len(duplicates)} of them are duplicates of properties we've already found.")
+            self.already_seen.add_many(duplicates)
+        return all_properties
+
+
+def stream_searches(searches, rules, config, fetcher, already_seen, registry, listings = None, deliver = None):
+    """Run searches through the streaming pipeline, passing properties to deliver (a function taking a dict of them)
+    as soon as they're ready. Returns all the properties that made it through, like scrape.run_searches."""
+    return Pipeline(searches, rules, config, fetcher, already_seen, registry, listings, deliver).run()
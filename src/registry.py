@@ -0,0 +1,25 @@
+import threading
+
+
+class PropertyRegistry:
+    """Every property parsed during a run, by id.
+    Searches that overlap share one Property object per id, so each property is only parsed and enriched once a run."""
+
+    def __init__(self):
+        self.properties = {}
+        self.lock = threading.Lock()
+
+    def known(self, ids):
+        "The ids that some search has already parsed"
+        with self.lock:
+            return {i for i in ids if i in self.properties}
+
+    def get(self, ids):
+        with self.lock:
+            return {i : self.properties[i] for i in ids}
+
+    def register(self, search):
+        "Add a search's properties, swapping in the existing object for any we already had"
+        with self.lock:
+            for id_, prop in search.properties.items():
+                search.properties[id_] = self.properties.setdefault(id_, prop)
@@ -1,10 +1,10 @@
-from bs4 import BeautifulSoup
 import re
-import numpy as np
+import sys
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from typing import ClassVar, Optional
 import rapidjson
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from dataclasses import dataclass, field
-import requests
 import dateutil.parser
 from collections import Counter
 
@@ -12,7 +12,10 @@ import logging, logging.handlers
 logger = logging.getLogger("")
 logger.setLevel(logging.INFO)
 
-from utils import Property, random_chunk
+from utils import Property, already_have
+from fetch import as_fetcher
+from extract import script_text
+from metrics import metrics
 
 rightmove_keymap = {
     "id" : "id",
@@ -22,6 +25,13 @@ rightmove_keymap = {
     'propertyTypeFullDescription' : "title",
 }
 
+def monthly_price(raw):
+    if raw["price"]['frequency'] == "monthly":
+        return raw["price"]["amount"]
+    if raw["price"]['frequency'] == "weekly":
+        return raw["price"]["amount"] * 52 // 12
+    return None
+
 def format_rightmove_properties(raw):
     assert(raw["price"]['currencyCode'] == 'GBP')
     
@@ -34,44 +44,112 @@ def format_rightmove_properties(raw):
     out.listedAt = dateutil.parser.isoparse(raw['firstVisibleDate'])
     out.latitude = raw["location"]['latitude']
     out.longitude = raw["location"]['longitude']
-    out.agent = raw["customer"]['brandTradingName']
+    # Lots of properties come from the same few agents, so share one copy of each name
+    out.agent = sys.intern(raw["customer"]['brandTradingName'])
     out.availableFrom = None
     out.url = "https://rightmove.co.uk" + raw['propertyUrl']
 
 
-    if raw["price"]['frequency'] == "monthly":
-        out.price = raw["price"]["amount"]
-    if raw["price"]['frequency'] == "weekly":
-        out.price = raw["price"]["amount"] * 52 // 12
+    out.price = monthly_price(raw)
     assert(out.price != None)
     
 
     return out
 
 
+PAGE_SIZE = 24
+# What a property page answers with once the listing has been taken down
+GONE_STATUSES = {404, 410}
+NEWEST_FIRST = "6" # the sortType for "Newest Listed"
+
+def page_url(url, index):
+    "The url of the page of search results starting at result number index"
+    u = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(u.query) if k != "index"]
+    if index: query.append(("index", str(index)))
+    return urlunparse(u._replace(query = urlencode(query)))
+
+def parse_search_page(r):
+    "Get the window.jsonModel data out of a page of search results"
+    # find the script tag that contains the data we want
+    script_content = script_text(r, "window.jsonModel = ")
+
+    #pull out all the var name = [...] lines from the script using a regex
+    json = re.match(r"window.jsonModel = (.*)", script_content).group(1)
+
+    with metrics.stage("json_decode"):
+        return rapidjson.loads(json, parse_mode = rapidjson.PM_TRAILING_COMMAS | rapidjson.PM_COMMENTS)
+
+def page_offsets(data):
+    "The index of the first result on each page after the first"
+    try:
+        offsets = [int(o["value"]) for o in data["pagination"]["options"]]
+    except (KeyError, TypeError, ValueError):
+        total = int(str(data.get("resultCount", "0")).replace(",", ""))
+        offsets = list(range(0, total, PAGE_SIZE))
+    return [o for o in offsets if o > 0]
+
+
 @dataclass
 class RightmoveSearch:
     name: str
     url: str
     properties: dict = field(default_factory = dict)
-    
-    def make_request(self, session = None):
-        if session is None: session = requests
-        r = session.get(self.url)
-        soup = BeautifulSoup(r.text, 'html.parser')
-
-        # find the script tag that contains the data we want
-        script_content = soup.find(lambda tag:tag.name=="script" and "window.jsonModel = " in tag.text).text
-
-        #pull out all the var name = [...] lines from the script using a regex
-        json = re.match(r"window.jsonModel = (.*)", script_content).group(1)
-
-        data = rapidjson.loads(json, parse_mode = rapidjson.PM_TRAILING_COMMAS | rapidjson.PM_COMMENTS)
+    max_pages: Optional[int] = None
+    # The price of every result, including the ones we skip, so history.History can follow prices
+    prices: dict = field(default_factory = dict, repr = False)
+    # One page per property, so there's nothing to gain from batching them up for more_info
+    details_batch: ClassVar[int] = 1
+    # Set by more_info, the properties whose listings have been taken down and the ones whose pages we couldn't read
+    gone: set = field(default_factory = set, repr = False)
+    broken: set = field(default_factory = set, repr = False)
+
+    def make_request(self, session = None, seen = None, shared = None):
+        """Run the search, reading every page of results. seen and shared are optional functions that take a list of ids
+        and return the ones we've seen before and the ones another search has already parsed this run,
+        see utils.already_have. Both are dropped before we spend any time building Property objects for them."""
+        fetcher = as_fetcher(session)
+        r = fetcher.get(self.url)
+        r.raise_for_status()
+        first = parse_search_page(r)
+        results = first["properties"]
+        old, elsewhere = already_have([f"rightmove:{p['id']}" for p in results], seen, shared)
+        skipped = old | elsewhere
+
+        # When results are newest first, once a whole page is stuff we've seen there's nothing new further on.
+        # Only what we've seen in earlier runs counts, another search parsing a page says nothing about the ones after it.
+        newest_first = dict(parse_qsl(urlparse(self.url).query)).get("sortType") == NEWEST_FIRST
+        def all_seen(page, old): return newest_first and seen and page and len(old) == len(page)
+
+        offsets = page_offsets(first)
+        if self.max_pages: offsets = offsets[: self.max_pages - 1]
+        if all_seen(results, old): offsets = []
+
+        # Fetch the other pages a few at a time, as many as we're currently allowed to have in flight to rightmove at once
+        i = 0
+        while i < len(offsets):
+            wave = fetcher.limiter.limit(self.url)
+            pages = dict(fetcher.fetch_all(offsets[i : i + wave], url = lambda index: page_url(self.url, index)))
+            i += wave
+            stop = False
+            for index in sorted(pages):
+                page = parse_search_page(pages[index])["properties"]
+                old, elsewhere = already_have([f"rightmove:{p['id']}" for p in page], seen, shared)
+                results += page
+                skipped |= old | elsewhere
+                if all_seen(page, old): stop = True
+            if stop:
+                logger.debug(f"Search {self.name} only had properties we've seen by result {index}, stopping there")
+                break
 
         #parse that into a dictionary
-        self.properties = {f"rightmove:{p['id']}" : format_rightmove_properties(p) for p in data["properties"]}
+        self.properties = {
+            f"rightmove:{p['id']}" : format_rightmove_properties(p)
+            for p in results if f"rightmove:{p['id']}" not in skipped
+        }
 
-        logger.info(f"Search {self.name} returned {len(self.properties)} results")
+        self.prices = {f"rightmove:{p['id']}" : monthly_price(p) for p in results}
+        logger.info(f"Search {self.name} returned {len(results)} results, skipping {len(skipped)}")
         return self
 
     def filter(self, filter_func):
@@ -85,54 +163,67 @@ class RightmoveSearch:
         return reasons
 
     def more_info(self, session = None):
-        "Use an undocumented openrent api to get extra details about the properties"
-        # iterate over the properties and grab random numbers of them 
-        logger.debug(f"Pulling more data about the results from the openrent API")
-        if session is None: session = requests
-        for id, p in self.properties.items():
-            r = session.get(p.url)
-            soup = BeautifulSoup(r.text, 'html.parser')
-
-            # find the script tag that contains the data we want
-            script_content = soup.find(lambda tag:tag.name=="script" and "window.PAGE_MODEL = " in tag.text).text
-            #pull out all the var name = [...] lines from the script using a regex
-            json = re.match(r"[\s]*window.PAGE_MODEL = (.*)", script_content).group(1)
-            data = rapidjson.loads(json, parse_mode = rapidjson.PM_TRAILING_COMMAS | rapidjson.PM_COMMENTS)
-            data = data['propertyData']
-            # print(data)
-
-            try: p.title = data["address"]["displayAddress"]
-            except KeyError: pass
-
-            try: p.floorPlanUrl = data["floorplans"][0]["url"]
-            except (KeyError, IndexError): pass
-
-            try: p.contactTelephone = data['contactInfo']['telephoneNumbers']['localNumber']
-            except KeyError: pass
-            
-            try: p.isFurnished = data['lettings']['furnishType'] == 'Furnished'
-            except KeyError: pass
-
-            try: 
-                sizes = {d["unit"] : d["minimumSize"] for d in data["sizings"]}
-                p.size = sizes["sqm"]
-            except KeyError: pass
-
-            try: 
-                date_str = data['lettings']['letAvailableDate']
-                now = datetime.now(timezone.utc)
-                if date_str: 
-                    if "now" in date_str.lower(): p.availableFrom = now
-                    else: p.availableFrom = dateutil.parser.parse(data['lettings']['letAvailableDate'], default = now, dayfirst = True)
-            except KeyError: pass
-            except dateutil.parser._parser.ParserError as e: logger.warn(e)
-
-            try:
-                if data['keyFeatures']:
-                    p.description = "Key Features: " + ", ".join(data['keyFeatures'])
-                else: p.description = ""
-            except KeyError: pass
-
+        """Fetch each property's page to get extra details about it, returning the ids of the ones we got.
+        Listings that have been taken down end up in self.gone and pages we couldn't read in self.broken."""
+        logger.debug(f"Pulling more data about the results from the property pages")
+        fetcher = as_fetcher(session)
+        enriched, self.gone, self.broken = set(), set(), set()
+        def failed(p, e):
+            if getattr(e, "response", None) is not None and e.response.status_code in GONE_STATUSES: self.gone.add(p.id)
+        for p, r in fetcher.fetch_all(self.properties.values(), url = lambda p: p.url, on_error = failed):
+            # One odd page shouldn't cost us every other property's details
             try:
-                p.nearestStation = data["nearestStations"][0]["name"]
-            except (KeyError, IndexError): pass
+                self.add_details(p, r)
+            except (ValueError, KeyError, AttributeError, TypeError) as e:
+                logger.warning(f"Couldn't read the details of {p.url}, skipping it: {e!r}")
+                self.broken.add(p.id)
+                continue
+            enriched.add(p.id)
+        return enriched
+
+    def add_details(self, p, r):
+        "Fill in a property from its page"
+        # find the script tag that contains the data we want
+        script_content = script_text(r, "window.PAGE_MODEL = ")
+        #pull out all the var name = [...] lines from the script using a regex
+        json = re.match(r"[\s]*window.PAGE_MODEL = (.*)", script_content).group(1)
+        with metrics.stage("json_decode"):
+            data = rapidjson.loads(json, parse_mode = rapidjson.PM_TRAILING_COMMAS | rapidjson.PM_COMMENTS)
+        data = data['propertyData']
+        # print(data)
+
+        try: p.title = data["address"]["displayAddress"]
+        except KeyError: pass
+
+        try: p.floorPlanUrl = data["floorplans"][0]["url"]
+        except (KeyError, IndexError): pass
+
+        try: p.contactTelephone = data['contactInfo']['telephoneNumbers']['localNumber']
+        except KeyError: pass
+        
+        try: p.isFurnished = data['lettings']['furnishType'] == 'Furnished'
+        except KeyError: pass
+
+        try: 
+            sizes = {d["unit"] : d["minimumSize"] for d in data["sizings"]}
+            p.size = sizes["sqm"]
+        except KeyError: pass
+
+        try: 
+            date_str = data['lettings']['letAvailableDate']
+            now = datetime.now(timezone.utc)
+            if date_str: 
+                if "now" in date_str.lower(): p.availableFrom = now
+                else: p.availableFrom = dateutil.parser.parse(data['lettings']['letAvailableDate'], default = now, dayfirst = True)
+        except KeyError: pass
+        except dateutil.parser._parser.ParserError as e: logger.warn(e)
+
+        try:
+            if data['keyFeatures']:
+                p.description = "Key Features: " + ", ".join(data['keyFeatures'])
+            else: p.description = ""
+        except KeyError: pass
+
+        try:
+            p.nearestStation = data["nearestStations"][0]["name"]
+        except (KeyError, IndexError): pass
@@ -0,0 +1,278 @@
+from dataclasses import dataclass, field
+from collections import Counter
+from datetime import datetime
+from typing import Any, Optional
+import operator
+import re
+
+import logging
+logger = logging.getLogger("")
+
+from keywords import KeywordMatcher
+from utils import lazy_import
+np = lazy_import("numpy")
+from geo import WALKING_FACTOR, coordinates, haversine_m, in_polygon, load_stations
+
+# Rules are written as plain dicts so they can come straight out of config.yml:
+#
+#   - name: unfurnished
+#     reason: "🛋 Unfurnished"
+#     reject_if:
+#       - {field: isFurnished, equals: false}
+#
+# A property is rejected by a rule when every condition in reject_if holds.
+# Conditions compare a Property field with one of the operators below.
+# Missing values (None) never satisfy less_than/greater_than/matches, like the old hand written checks.
+
+def _compare(op):
+    def row(value, target):
+        return value is not None and op(value, target)
+    def column(col, target):
+        if isinstance(target, datetime): target = target.timestamp()
+        try: col = col.astype(float)
+        except (TypeError, ValueError): return None # mixed in Nones, leave it to the row check
+        return op(col, target)
+    return row, column
+
+OPERATORS = {
+    "equals": (lambda value, target: value == target, lambda col, target: np.asarray(col == target, dtype = bool)),
+    "not_equals": (lambda value, target: value != target, lambda col, target: ~np.asarray(col == target, dtype = bool)),
+    "less_than": _compare(operator.lt),
+    "greater_than": _compare(operator.gt),
+    "matches": (lambda value, pattern: bool(value) and pattern.search(value) is not None, None),
+}
+
+# How expensive each operator is to check, cheap rules run first so most properties are rejected quickly
+OPERATOR_COSTS = {"equals": 1, "not_equals": 1, "less_than": 1, "greater_than": 1, "matches": 5}
+
+
+@dataclass
+class Condition:
+    field: str
+    op: str
+    target: Any
+
+    def __post_init__(self):
+        if self.op not in OPERATORS:
+            raise ValueError(f"Unknown rule operator {self.op}, expected one of {', '.join(OPERATORS)}")
+        if self.op == "matches": self.target = re.compile(self.target, re.IGNORECASE)
+
+    @classmethod
+    def from_dict(cls, d):
+        (op, target), = ((k, v) for k, v in d.items() if k != "field")
+        return cls(d["field"], op, target)
+
+    def row(self, prop):
+        return OPERATORS[self.op][0](getattr(prop, self.field), self.target)
+
+    def column(self, columns):
+        "Evaluate over arrays of results, None if that isn't possible"
+        column_op = OPERATORS[self.op][1]
+        if column_op is None or self.field not in columns: return None
+        return column_op(columns[self.field], self.target)
+
+
+@dataclass
+class Rule:
+    name: str
+    reason: str
+    conditions: list[Condition]
+    cost: int = 1
+    log: Optional[str] = None # logged with .format(prop = prop) when filtering verbosely
+
+    @classmethod
+    def from_dict(cls, d):
+        conditions = [Condition.from_dict(c) for c in d["reject_if"]]
+        cost = d.get("cost", max(OPERATOR_COSTS[c.op] for c in conditions))
+        return cls(d.get("name", d["reason"]), d["reason"], conditions, cost, d.get("log"))
+
+    def rejects(self, prop):
+        return all(c.row(prop) for c in self.conditions)
+
+    def check(self, prop, verbose = False):
+        "The reason this rule rejects prop, or None if it doesn't"
+        if not self.rejects(prop): return None
+        if verbose and self.log: logger.info(self.log.format(prop = prop))
+        return self.reason
+
+    def column_rejects(self, columns):
+        "Boolean array of the rows this rule rejects, or None if it can't be checked on columns"
+        rejects = None
+        for c in self.conditions:
+            col = c.column(columns)
+            if col is None: return None
+            rejects = col if rejects is None else rejects & col
+        return rejects
+
+
+@dataclass
+class KeywordRule(Rule):
+    """Requires a description to mention one of the search keywords and none of its excluded ones,
+    recording the keywords it found on prop.keywords"""
+    matcher: KeywordMatcher = field(default_factory = KeywordMatcher)
+
+    def check(self, prop, verbose = False):
+        prop.keywords, excluded = self.matcher.find(prop.description)
+        if excluded:
+            if verbose: logger.info(f"🚫 {prop.id} mentions {', '.join(excluded)}.")
+            return "🚫 Excluded keyword"
+        if prop.description and self.matcher.keywords and not prop.keywords:
+            if verbose: logger.info(self.log.format(prop = prop))
+            return self.reason
+        return None
+
+    def column_rejects(self, columns):
+        return None
+
+
+@dataclass
+class LocationRule(Rule):
+    """A rule about where a property is, checked with far() on arrays of coordinates so it works on columns too.
+    Properties without a location are never rejected."""
+
+    def far(self, lat, lon):
+        raise NotImplementedError
+
+    def rejects(self, prop):
+        return bool(self.far(*coordinates(prop.latitude, prop.longitude))[0])
+
+    def column_rejects(self, columns):
+        if "latitude" not in columns or "longitude" not in columns: return None
+        return self.far(*coordinates(columns["latitude"], columns["longitude"]))
+
+
+@dataclass
+class DistanceRule(LocationRule):
+    "Rejects properties more than max_m metres from a point"
+    latitude: float = 0.0
+    longitude: float = 0.0
+    max_m: float = 0.0
+
+    def far(self, lat, lon):
+        with np.errstate(invalid = "ignore"):
+            return haversine_m(lat, lon, self.latitude, self.longitude) > self.max_m
+
+
+@dataclass
+class AreaRule(LocationRule):
+    "Rejects properties outside all of a list of polygons, each a list of [latitude, longitude] corners"
+    polygons: list = field(default_factory = list)
+
+    def far(self, lat, lon):
+        inside = np.zeros(lat.shape, dtype = bool)
+        for polygon in self.polygons: inside |= in_polygon(lat, lon, polygon)
+        return ~inside & ~np.isnan(lat) & ~np.isnan(lon)
+
+
+@dataclass
+class StationRule(LocationRule):
+    """Rejects properties more than max_walk_m metres walk from a station, estimating walks from straight line distances.
+    Fills in prop.nearestStation when the listing didn't say."""
+    stations: Any = None
+    max_walk_m: float = 0.0
+
+    def nearest(self, lat, lon):
+        return self.stations.nearest(lat, lon, self.max_walk_m / WALKING_FACTOR)
+
+    def far(self, lat, lon):
+        distances, _ = self.nearest(lat, lon)
+        return np.isinf(distances) & ~np.isnan(lat) & ~np.isnan(lon)
+
+    def check(self, prop, verbose = False):
+        lat, lon = coordinates(prop.latitude, prop.longitude)
+        if np.isnan(lat[0]) or np.isnan(lon[0]): return None
+        distances, nearest = self.nearest(lat, lon)
+        if nearest[0] >= 0:
+            if not prop.nearestStation:
+                prop.nearestStation = f"{self.stations.names[nearest[0]]} ({distances[0] * WALKING_FACTOR:.0f}m walk)"
+            return None
+        if verbose and self.log: logger.info(self.log.format(prop = prop))
+        return self.reason
+
+
+def location_rules(config, search_info):
+    "Rules for a search's max_distance, areas and max_station_walk_m settings"
+    rules = []
+    for point in search_info.max_distance:
+        place = point.get("name", f"{point['latitude']}, {point['longitude']}")
+        rules.append(DistanceRule("too_far", f"📍 Too far from {place}", [], cost = 2,
+                                  log = f"📍 {{prop.id}} is more than {point['km']}km from {place}.",
+                                  latitude = point["latitude"], longitude = point["longitude"], max_m = point["km"] * 1000))
+    if search_info.areas:
+        rules.append(AreaRule("outside_areas", "🗺 Outside search area", [], cost = 3,
+                              log = "🗺 {prop.id} is outside the search area.", polygons = search_info.areas))
+    if search_info.max_station_walk_m:
+        rules.append(StationRule("far_from_station", "🚉 Too far from a station", [], cost = 4,
+                                 log = f"🚉 {{prop.id}} is more than a {search_info.max_station_walk_m}m walk from a station.",
+                                 stations = load_stations(config.get("stations_file")), max_walk_m = search_info.max_station_walk_m))
+    return rules
+
+
+def default_rules(config, search_info):
+    "The rules every search gets unless it disables them, in the order they've always been checked"
+    rules = [
+        {"name": "available_too_soon", "reason": "⏳️ Available too soon", "reject_if": [{"field": "availableFrom", "less_than": config["start_date"]}]},
+        {"name": "studio", "reason": "Studio", "reject_if": [{"field": "isStudio", "equals": True}]},
+        {"name": "shared", "reason": "👥 Shared", "reject_if": [{"field": "isShared", "equals": True}]},
+        {"name": "not_live", "reason": "✖️ Not live", "reject_if": [{"field": "isLive", "equals": False}]},
+        {"name": "let_agreed", "reason": "🤝 Let already agreed", "reject_if": [{"field": "letAgreed", "equals": True}]},
+        {"name": "no_professionals", "reason": "💼 No professionals", "reject_if": [{"field": "acceptsProfessionals", "equals": False}]},
+        {"name": "openrent_on_rightmove", "reason": "An openrent place on rightmove", "reject_if": [{"field": "agent", "equals": "OpenRent"}]},
+    ]
+    if search_info.min_size_square_meters:
+        rules.append({"name": "too_small", "reason": "🔬 Too small", "log": "🧘🏽 {prop.id} is too small at {prop.size}m^2",
+                      # A size of 0 means the listing didn't say, which the old check let through
+                      "reject_if": [{"field": "size", "greater_than": 0}, {"field": "size", "less_than": search_info.min_size_square_meters}]})
+    if search_info.max_price:
+        rules.append({"name": "too_expensive", "reason": "💰 Too expensive", "log": "💰 {prop.id} is too expensive at £{prop.price}",
+                      "reject_if": [{"field": "includesBills", "not_equals": True}, {"field": "price", "greater_than": search_info.max_price}]})
+    if search_info.max_price_with_bills:
+        rules.append({"name": "too_expensive_with_bills", "reason": "💰 Too expensive", "log": "💰 {prop.id} is too expensive at £{prop.price} with bills",
+                      "reject_if": [{"field": "includesBills", "equals": True}, {"field": "price", "greater_than": search_info.max_price_with_bills}]})
+    # Filter out agents that start with "We are proud to"
+    rules.append({"name": "from_agent", "reason": "😤 From agent", "log": "😡 {prop.id} is from an agent.",
+                  "reject_if": [{"field": "description", "matches": r"^we are[ ]?[\S]* proud"}]})
+    return rules
+
+
+class RulePipeline:
+    "A search's rules compiled once, cheapest first, that can check a single property or filter whole columns of them"
+
+    def __init__(self, rules):
+        # sorted() is stable so rules of the same cost keep the order they were given in
+        self.rules = sorted(rules, key = lambda r: r.cost)
+
+    def __call__(self, prop, verbose = False) -> tuple[bool, str]:
+        for rule in self.rules:
+            reason = rule.check(prop, verbose)
+            if reason: return False, reason
+        return True, "✅ Kept"
+
+    def mask(self, columns) -> tuple["np.ndarray", Counter]:
+        """Apply every rule that can work on columns, returning a mask of rows to keep and
+        counts of the first reason each dropped row was rejected for.
+        Rules that can't be checked on columns are left for the per property pass."""
+        keep = np.ones(len(columns["id"]), dtype = bool)
+        reasons = Counter()
+        for rule in self.rules:
+            rejects = rule.column_rejects(columns)
+            if rejects is None: continue
+            rejects = rejects & keep
+            if rejects.any(): reasons[rule.reason] += int(rejects.sum())
+            keep &= ~rejects
+        return keep, reasons
+
+
+def compile_rules(config, search_info):
+    """Build the rule pipeline for a search from the default rules plus any in the top level or per search
+    `rules` config, minus any named in `disable_rules`"""
+    specs = default_rules(config, search_info) + config.get("rules", []) + search_info.rules
+    disabled = set(config.get("disable_rules", [])) | set(search_info.disable_rules)
+    rules = [Rule.from_dict(spec) for spec in specs if spec.get("name", spec["reason"]) not in disabled]
+    rules += [rule for rule in location_rules(config, search_info) if rule.name not in disabled]
+    if "keywords" not in disabled:
+        # Built once per search, so every property's description only gets scanned once for all its keywords
+        matcher = KeywordMatcher(search_info.keywords, search_info.exclude_keywords, search_info.whole_word_keywords)
+        rules.append(KeywordRule("keywords", "🗝 No keywords", [], cost = 10,
+                                 log = "🗝️ {prop.id} doesn't contain any keywords.", matcher = matcher))
+    return RulePipeline(rules)
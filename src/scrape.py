@@ -7,117 +7,63 @@ import dateutil.parser
 from datetime import datetime, timezone
 import yaml
 import sys
-import time
-import re
-from slack_sdk import WebClient
-from pathlib import Path
 from typing import Optional
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 
 from openrent import OpenRentSearch
 from rightmove import RightmoveSearch
-from utils import fmt_timedelta
+from fetch import Fetcher, make_session
+from seen import open_seen_store, ReadOnlySeen
+from rules import compile_rules
+from httpcache import open_http_cache
+from delivery import SlackDelivery, SeenOrQueued, open_outbox
+from registry import PropertyRegistry
+from dedup import open_listing_index
+from details import open_detail_store
+from history import open_history
+from metrics import metrics
 
-# Set up logging to both stout and to a file
 import logging, logging.handlers
 
 logger = logging.getLogger("")
-logger.setLevel(logging.INFO)
-# logger.setLevel(logging.DEBUG)
-file_handler = logging.handlers.RotatingFileHandler(
-    "data/scraper.log", maxBytes=100_000, backupCount=3,
-)
-sterr_handler = logging.StreamHandler(sys.stderr)
-
-# Logger handler that saves to an io.StringIO object that we can call getvalue() on to push it to slack.
-slack_logs = io.StringIO()
-slack_logs_handler = logging.StreamHandler(slack_logs)
-slack_logs_handler.setFormatter(logging.Formatter("%(message)s"))
-logger.addHandler(slack_logs_handler)
-
-# Format and handle the other two loggers
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-for handler in [file_handler, sterr_handler]:
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-logger.info("Starting...")
-
-
-def our_filter(prop, config, search_info, verbose = False) -> tuple[bool, str]:
-    if prop.availableFrom != None and prop.availableFrom < config["start_date"]:
-        return False, "⏳️ Available too soon"
-    if prop.isStudio == True:
-        return False, "Studio"
-    if prop.isShared == True:
-        return False, "👥 Shared"
-    if prop.isLive == False:
-        return False, "✖️ Not live"
-    if prop.letAgreed == True:
-        return False, "🤝 Let already agreed"
-
-    if prop.acceptsProfessionals == False:
-        return False, "💼 No professionals"
-    if prop.agent == "OpenRent":
-        return False, "An openrent place on rightmove"
-
-    if (
-        search_info.min_size_square_meters
-        and prop.size
-        and prop.size < search_info.min_size_square_meters
-    ):
-        if verbose: logger.info(f"🧘🏽 {prop.id} is too small at {prop.size}m^2")
-        return False, "🔬 Too small"
-    if (
-        search_info.max_price
-        and (prop.includesBills in [None, False])
-        and prop.price > search_info.max_price
-    ):
-        if verbose: logger.info(f"💰 {prop.id} is too expensive at £{prop.price}")
-        return False, "💰 Too expensive"
-    if (
-        search_info.max_price_with_bills
-        and (prop.includesBills == True)
-        and prop.price > search_info.max_price_with_bills
-    ):
-        if verbose: logger.info(f"💰 {prop.id} is too expensive at £{prop.price} with bills")
-        return False, "💰 Too expensive"
-
-    prop.keywords = []
-    if prop.description:
-
-        # Filter out agents that start with "We are proud to"
-        if re.match(r"^we are[ ]?[\S]* proud", prop.description.lower()):
-            if verbose: logger.info(f"😡 {prop.id} is from an agent.")
-            return False, "😤 From agent"
-
-        prop.keywords = [k for k in search_info.keywords if k in prop.description.lower()]
-        if search_info.keywords and not prop.keywords: 
-            if verbose: logger.info(f"🗝️ {prop.id} doesn't contain any keywords.")
-            return False, "🗝 No keywords"
-
-    return True, "✅ Kept"
-
-
-def load_config():
-    "Load the config with a json parser that allows trailing commas"
-    with open("data/config.yml") as f:
-        return yaml.safe_load(f)
 
 
-def load_seen_properties(fname):
-    # get our local list of properties we've already seen
-    p = Path(fname)
-    if not p.exists():
-        logger.critical(f"{p} does not exist, creating it.")
-        p.touch()
+def setup_logging():
+    """Set up logging to both stout and to a file.
+    Returns an io.StringIO that also gets the logs, that we can call getvalue() on to push them to slack."""
+    logger.setLevel(logging.INFO)
+    # logger.setLevel(logging.DEBUG)
+    file_handler = logging.handlers.RotatingFileHandler(
+        "data/scraper.log", maxBytes=100_000, backupCount=3,
+    )
+    stderr_handler = logging.StreamHandler(sys.stderr)
+
+    # Logger handler that saves to an io.StringIO object that we can call getvalue() on to push it to slack.
+    slack_logs = io.StringIO()
+    slack_logs_handler = logging.StreamHandler(slack_logs)
+    slack_logs_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(slack_logs_handler)
 
-    with open(p, "r") as f:
-        checked_property_ids = set(i for i in f.read().split("\n") if i != "")
+    # Format and handle the other two loggers
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    for handler in [file_handler, stderr_handler]:
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
 
-    return checked_property_ids
+    return slack_logs
+
+
+CONFIG_PATH = "data/config.yml"
+
+def load_config(path=CONFIG_PATH):
+    "Load the config with a json parser that allows trailing commas"
+    with open(path) as f:
+        return yaml.safe_load(f)
 
 
 @dataclass
@@ -128,138 +74,295 @@ class Search:
     max_price_with_bills: Optional[float] = None
     min_size_square_meters: Optional[float] = None
     keywords: list[str] = field(default_factory=list)
+    exclude_keywords: list[str] = field(default_factory=list)
+    whole_word_keywords: bool = False
+    max_pages: Optional[int] = None # only read this many pages of rightmove results
+    interval_minutes: Optional[float] = None # how often daemon.py runs this search, defaults to poll_interval_minutes
+    max_distance: list[dict] = field(default_factory=list) # points, each with a latitude, longitude, km and optional name
+    areas: list[list] = field(default_factory=list) # polygons of [latitude, longitude] corners to search inside
+    max_station_walk_m: Optional[float] = None
+    rules: list[dict] = field(default_factory=list)
+    disable_rules: list[str] = field(default_factory=list)
 
 def log_reasons(reasons):
     "Format the reasons counter object and log it"
     reasons_str = ', '.join(f'{k}:{v}' for k,v in reasons.items())
     logger.info(f"Reasons: {reasons_str}")
 
-def search_properties(config, filter=None, already_seen=None):
-    "Return properties from search urls in config, with optional filter function and already_seen set"
+def make_search(search_info, config, details=None):
+    "Pick the right scraper for a search url, details is the details.DetailStore for OpenRent searches to use"
+    netloc = urlparse(search_info.url).netloc
+
+    if netloc.endswith("openrent.co.uk"):
+        return OpenRentSearch(
+            search_info.name, search_info.url, columnar=config.get("columnar", False),
+            details=details, random_chunks=(config.get("openrent_details") or {}).get("random_chunks", False),
+        )
+
+    elif netloc.endswith("rightmove.co.uk"):
+        return RightmoveSearch(search_info.name, search_info.url, max_pages=search_info.max_pages)
+
+    else:
+        raise ValueError(f"Don't (yet) know how to scrape {netloc}.")
+
+def find_candidates(search, rules, fetcher, already_seen, registry):
+    "Run a search and cut its results down to the new properties that pass its rules, before getting any extra info"
+    # Properties another search has already parsed this run get shared with this one rather than parsed again
+    shared = set()
+    def seen(ids):
+        with metrics.stage("seen_check"):
+            return already_seen.seen_many(ids)
+    def parsed_elsewhere(ids):
+        known = registry.known(ids)
+        shared.update(known)
+        return known
+
+    # do the search, dropping anything we've already seen before it gets parsed any further
+    search.make_request(fetcher, seen=seen, shared=parsed_elsewhere)
+
+    # Filter the results based on criteria
+    reasons = Counter()
+    if getattr(search, "columnar", False):
+        # Knock out most of the results while they're still arrays, then build Property objects for the rest
+        with metrics.stage("filter"):
+            reasons = search.filter_columns(rules.mask)
+        search.materialise()
+    registry.register(search)
+    search.properties.update(registry.get(shared))
+
+    with metrics.stage("filter"):
+        reasons += search.filter(rules)
+    logger.info(f"{search.name}: {len(search.properties)} of the results match our criteria.")
+    log_reasons(reasons)
+    if not search.properties: return search
+
+    # Ignore anything we've already seen
+    with metrics.stage("seen_check"):
+        seen = already_seen.seen_many(search.properties.keys())
+    reasons = search.filter(lambda p: (p.id not in seen, "Already seen"))
+    logger.info(f"{search.name}: {len(search.properties)} of those are new to us.")
+    return search
+
+def try_find_candidates(search, rules, fetcher, already_seen, registry):
+    "find_candidates, but a search whose site is down or blocking us comes back empty rather than stopping the others"
+    try:
+        return find_candidates(search, rules, fetcher, already_seen, registry)
+    except (requests.RequestException, ValueError) as e:
+        # ValueError is extract.script_text not finding the data, usually a block page we didn't recognise
+        logger.error(f"Search {search.name} failed, carrying on without it: {e}")
+        search.properties, search.prices = {}, {}
+        return search
+
+def more_info(searches, fetcher, pool):
+    """Grab any extra info that requires making per property requests. Returns the ids of the properties we got it for,
+    the ones whose listings have gone and the ones we couldn't read, see give_up_on.
+    This is done once for the union of every search's candidates, so properties in more than one search only get fetched once."""
+    by_portal = {}
+    for search in searches:
+        by_portal.setdefault(type(search), (search, {}))[1].update(search.properties)
+    # Copies of the first search for each portal, so they keep its settings
+    enrichments = [replace(first, name="all searches", properties=properties) for first, properties in by_portal.values() if properties]
+    def enrich(search):
+        try:
+            return search.more_info(fetcher)
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Couldn't get extra info from {urlparse(search.url).netloc}: {e}")
+            return set()
+    got_info = set().union(*pool.map(enrich, enrichments))
+    gone = set().union(*(search.gone for search in enrichments))
+    broken = set().union(*(search.broken for search in enrichments))
+    return got_info, gone, broken
+
+def give_up_on(already_seen, gone, broken, config):
+    """Mark as seen the properties whose listings have been taken down, and the ones whose details we've now failed
+    to read in max_detail_failures runs, so that we stop fetching them every run"""
+    given_up = set(gone) | already_seen.count_failures(broken, config.get("max_detail_failures", 3))
+    if given_up:
+        logger.info(f"Giving up on {len(given_up)} properties that have been taken down or keep failing.")
+        already_seen.add_many(given_up)
+
+def record_history(history, searches, registry, all_properties):
+    "Record every property the searches parsed and every price they saw, noting which properties made it through"
+    prices = {}
+    for search in searches:
+        prices.update(search.prices)
+    with metrics.stage("history"):
+        changed = history.observe(prices)
+        history.record(registry.properties.values(), matched=all_properties.keys())
+    logger.info(f"Recorded {len(registry.properties)} properties and {changed} new prices in the history.")
+
+def parse_start_date(config):
+    "Turn the start_date in config into the datetime the rules compare against"
     config["start_date"] = dateutil.parser.parse(
         str(config["start_date"]), default=datetime.now(timezone.utc)
     )
-    all_properties = {}
 
-    with requests.session() as s:
-        for i, search_info in enumerate([Search(**s) for s in config["searches"]]):
-            netloc = urlparse(search_info.url).netloc
-
-            if netloc.endswith("openrent.co.uk"):
-                search = OpenRentSearch(search_info.name, search_info.url)
-
-            elif netloc.endswith("rightmove.co.uk"):
-                search = RightmoveSearch(search_info.name, search_info.url)
-
-            else:
-                raise ValueError(f"Don't (yet) know how to scrape {netloc}.")
-
-            # do the search
-            search.make_request(s)
-
-            # Filter the results based on criteria
-            reasons = search.filter(lambda p: our_filter(p, config, search_info))
-            logger.info(f"{len(search.properties)} of the results match our criteria.")
-            log_reasons(reasons)
-            if not search.properties: continue
-
-            # Ignore anything we've already seen
-            reasons = search.filter(lambda p: (p.id not in already_seen, "Already seen"))
-            logger.info(f"{len(search.properties)} of those are new to us.")
-            if not search.properties: continue
-
-            # update the list of known properties
-            with open(config["checked_properties_list"], "a") as f:
-                if len(search.properties.keys()) > 0:
-                    f.write("\n" + "\n".join(str(i) for i in search.properties.keys()))
-
-            # Grab any extra info that requires making per property requests
-            # Do this after filtering out the obvious ones you don't want
-            search.more_info(s)
+def run_searches(search_infos, config, fetcher, already_seen, listings=None, details=None, history=None, deliver=None):
+    """Run some searches concurrently using an already open fetcher, returning the properties they found.
+    If given a dedup.ListingIndex, properties that look like reposts of ones we've already found are dropped.
+    If given a details.DetailStore, OpenRent details fetched recently are reused instead of asked for again.
+    If given a history.History, every property parsed and every price seen is recorded in it.
+    With streaming set in config the searches go through pipeline.stream_searches instead, which hands properties
+    to deliver (a function taking a dict of them) as soon as each one is ready."""
+    parse_start_date(config)
+    concurrency = config.get("concurrency", {})
+    searches = [make_search(search_info, config, details) for search_info in search_infos]
+    rules = [compile_rules(config, search_info) for search_info in search_infos]
+    registry = PropertyRegistry()
+
+    if config.get("streaming"):
+        from pipeline import stream_searches
+        all_properties = stream_searches(searches, rules, config, fetcher, already_seen, registry, listings, deliver)
+        if history is not None: record_history(history, searches, registry, all_properties)
+        return all_properties
+
+    with ThreadPoolExecutor(max_workers=concurrency.get("max_workers", 4)) as pool:
+        list(pool.map(
+            lambda pair: try_find_candidates(*pair, fetcher, already_seen, registry),
+            zip(searches, rules),
+        ))
+
+        # Do this after filtering out the obvious ones you don't want
+        with metrics.stage("enrich"):
+            got_info, gone, broken = more_info(searches, fetcher, pool)
+
+    # Leave out anything we couldn't get the extra info for rather than judge or post it half filled in.
+    # It isn't marked as seen, so it gets another go next run, unless it's gone or keeps failing.
+    missing = set()
+    for search in searches:
+        missing |= search.properties.keys() - got_info
+        search.properties = {id_ : p for id_, p in search.properties.items() if id_ in got_info}
+    if missing: logger.warning(f"Couldn't get extra info for {len(missing)} properties, leaving them for next time.")
+    give_up_on(already_seen, gone, broken, config)
+
+    # Do an extra filter pass for each search in case this extra info means that we now don't pass the test.
+    # Going through the searches in config order keeps the results deterministic when searches overlap,
+    # a property in several searches ends up with the keywords from the last one that kept it.
+    all_properties, keywords = {}, {}
+    enriched = set()
+    for search, search_rules in zip(searches, rules):
+        if not search.properties: continue
+        enriched |= search.properties.keys()
+        with metrics.stage("filter"):
+            reasons = search.filter(lambda p: search_rules(p, verbose=True))
+        logger.info(
+            f"{search.name}: {len(search.properties)} of the results match our criteria after getting extra info."
+        )
+        log_reasons(reasons)
+        all_properties.update(search.properties)
+        keywords.update((id_, p.keywords) for id_, p in search.properties.items())
+
+    for id_, prop in all_properties.items():
+        prop.keywords = keywords[id_]
+
+    # Remember the ones that failed everywhere so we don't fetch their details again next time,
+    # the ones that passed get marked as seen once they've been posted to slack
+    already_seen.add_many(enriched - all_properties.keys())
+
+    if listings is not None:
+        with metrics.stage("dedup"):
+            all_properties, duplicates = listings.drop_duplicates(all_properties)
+        logger.info(f"{len(duplicates)} of them are duplicates of properties we've already found.")
+        already_seen.add_many(duplicates)
+
+    if history is not None: record_history(history, searches, registry, all_properties)
+    return all_properties
 
-            # Do an extra filter pass in case this extra info means that we now don't pass the test
-            reasons = search.filter(lambda p: our_filter(p, config, search_info, verbose=True))
-            logger.info(
-                f"{len(search.properties)} of the results match our criteria after getting extra info."
-            )
-            log_reasons(reasons)
-            if not search.properties: continue
+def select_searches(config, names=None):
+    "The searches in config, or just the ones called one of names"
+    known = [s["name"] for s in config["searches"]]
+    unknown = set(names or []) - set(known)
+    if unknown:
+        raise ValueError(f"No search called {', '.join(sorted(unknown))}, the searches are {', '.join(known)}")
+    return [Search(**s) for s in config["searches"] if not names or s["name"] in names]
+
+def search_properties(config, already_seen=None, history=None, search_infos=None, deliver=None):
+    """Return properties from search urls in config, or search_infos if given,
+    that pass each search's rules and aren't in the already_seen store.
+    In streaming mode each one is also passed to deliver as soon as it's ready, see run_searches."""
+    cache = open_http_cache(config)
+    listings = open_listing_index(config)
+    details = open_detail_store(config)
+
+    with make_session(cache=cache) as session:
+        # One fetcher for the whole run so that rate limits apply across all the searches hitting a site
+        fetcher = Fetcher.from_config(session, config)
+        if search_infos is None: search_infos = select_searches(config)
+        all_properties = run_searches(search_infos, config, fetcher, already_seen, listings, details, history, deliver)
+
+    if listings is not None:
+        listings.close()
+    if details is not None:
+        details.close()
+    if cache is not None:
+        logger.info(cache.summary())
+        cache.close()
+    return all_properties
 
-            all_properties.update(search.properties)
 
+def post_debug_message(sc, config, all_properties, logs):
+    "Post a message that the bot ran to a differnt channel"
+    hostname = config.get("hostname", "dev_environment")
+    try:
+        sc.chat_postMessage(
+            channel=config.get("debug_slack_channel") or "bot_testing",
+            text=f"Ran at {datetime.now().strftime('%d %b %y %H:%M')} on {hostname}, found {len(all_properties)} new properties \n {logs}\n{metrics.summary()}",
+        )
+    except Exception as e:
+        # Not worth stopping the actual properties going out over
+        logger.error(f"Couldn't post to the debug channel: {e}")
+
+
+def main(config_path=CONFIG_PATH, search_names=None, dry_run=False, process_started=None):
+    """Run the searches in the config, or just the ones in search_names, and post what they find to slack.
+    A dry run logs what it found instead, without touching slack, the seen store, the outbox or the history.
+    process_started is a time.perf_counter() from as early as possible, to log how long we took to get going."""
+    slack_logs = setup_logging()
+    logger.info("Starting...")
+    metrics.reset()
+
+    # pull in config data
+    config = load_config(config_path)
+    search_infos = select_searches(config, search_names)
+    if process_started is not None:
+        metrics.observe("startup", time.perf_counter() - process_started)
+        logger.info(f"Started up in {(time.perf_counter() - process_started) * 1000:.0f} ms")
+
+    if dry_run:
+        # Don't let the duplicate index remember anything either, or the real run would think these were reposts
+        config = dict(config, dedup=None)
+        with open_seen_store(config, read_only=True) as already_seen_ids, open_outbox(config, read_only=True) as outbox:
+            all_properties = search_properties(config, ReadOnlySeen(SeenOrQueued(already_seen_ids, outbox)), search_infos=search_infos)
+        logger.info(f"Overall we found {len(all_properties)} new properties.")
+        for prop in all_properties.values():
+            logger.info(f"{prop.id}: £{prop.price} {prop.bedrooms} bed {prop.title} {prop.url}")
+        logger.info(metrics.summary())
+        metrics.write_from_config(config)
+        return all_properties
+
+    history = open_history(config)
+    started = datetime.now(timezone.utc).timestamp()
+    with open_seen_store(config) as already_seen_ids, open_outbox(config) as outbox:
+        from slack_sdk import WebClient
+        sc = WebClient(token=config["slack_token"])
+        delivery = SlackDelivery.from_config(sc, outbox, already_seen_ids, config)
+        # When streaming, properties get posted as they're found rather than all together at the end
+        streaming = config.get("streaming", False)
+        all_properties = search_properties(
+            config, already_seen=SeenOrQueued(already_seen_ids, outbox), history=history, search_infos=search_infos,
+            deliver=(lambda properties: delivery.deliver_now(config, properties)) if streaming else None,
+        )
+        logger.info(f"Overall we found {len(all_properties)} new properties.")
+
+        post_debug_message(sc, config, all_properties, slack_logs.getvalue())
+        if history is not None:
+            delivery.queue_price_drops(config, history.price_drops(started))
+            history.close()
+        # This also retries anything that didn't get sent last time
+        delivery.deliver(config, {} if streaming else all_properties)
+    metrics.write_from_config(config)
     return all_properties
 
 
-# pull in config data
-config = load_config()
-already_seen_ids = load_seen_properties(config["checked_properties_list"])
-all_properties = search_properties(
-    config, filter=our_filter, already_seen=already_seen_ids
-)
-hostname = config.get("hostname", "dev_environment")
-logger.info(f"Overall we found {len(all_properties)} new properties.")
-
-slack_token = config["slack_token"]
-sc = WebClient(token=slack_token)
-
-
-def floorplan(url):
-    return {
-        "type": "image",
-        "title": {"type": "plain_text", "text": "Floorplan", "emoji": True},
-        "image_url": url,
-        "alt_text": "Floor Plan",
-    }
-
-
-def property_description(p):
-    return {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": f"""
-<{p.url}|{p.title}>
-£{p.price} {'incl bills' if p.includesBills else ''}| {p.bedrooms} bed | Start {p.availableFrom.strftime('%d %b %y') if p.availableFrom else "?"} {'| UNFURNISHED!' if p.isFurnished == False else ''} {f'| {p.size} sq m' if p.size else ''}
-On {p.agent} for {fmt_timedelta(p.listedAt)}.
-{f"Nearest Station: {p.nearestStation}" if p.nearestStation else ""}
-{f"Keywords: {' '.join(s.capitalize() for s in p.keywords)}" if p.keywords else ""}
-{p.description}
-            """,
-        },
-        "accessory": {
-            "type": "image",
-            "image_url": p.imgUrl,
-            "alt_text": "Image of the flat",
-        },
-    }
-
-
-DIVIDER_BLOCK = {"type": "divider"}
-
-header = {
-    "type": "section",
-    "text": {
-        "type": "mrkdwn",
-        "text": (f"Found {len(all_properties)} new properties!"),
-    },
-}
-
-# post a message that the bot ran to a differnt channel
-sc.chat_postMessage(
-    channel=config.get("debug_slack_channel") or "bot_testing",
-    text=f"Ran at {datetime.now().strftime('%d %b %y %H:%M')} on {hostname}, found {len(all_properties)} new properties \n {slack_logs.getvalue()}",
-)
-
-logger.debug(f"Properties: {all_properties}")
-for id_, prop in all_properties.items():
-    blocks = [
-        property_description(prop),
-    ]
-    # if prop.floorPlanUrl: blocks.append(floorplan(prop.floorPlanUrl))
-
-    sc.chat_postMessage(
-        channel=prop.slack_channel or config.get("slack_channel") or "openrent",
-        text="New property found!",
-        blocks=blocks,
-    )
-    time.sleep(0.1)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import threading
+
+import logging
+logger = logging.getLogger("")
+
+from db import Database, chunks
+from bloom import BloomFilter
+
+
+class TextSeenStore:
+    "The original seen list, a text file of ids that gets read into memory in full"
+
+    def __init__(self, path, create = True):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.ids = set()
+        # There's nowhere in the file to keep these, so they only last as long as the process, e.g. the daemon's
+        self.failures = Counter()
+        if not self.path.exists():
+            if not create: return
+            logger.critical(f"{self.path} does not exist, creating it.")
+            self.path.touch()
+        with open(self.path, "r") as f:
+            self.ids = set(i for i in f.read().split("\n") if i != "")
+
+    def __contains__(self, id_):
+        return id_ in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def all_ids(self):
+        return iter(self.ids)
+
+    def seen_many(self, ids):
+        # Locked as well, in streaming mode properties get marked as seen while other searches are still checking
+        with self.lock:
+            return set(ids) & self.ids
+
+    def add_many(self, ids):
+        ids = [str(i) for i in ids if i not in self.ids]
+        if not ids: return
+        with self.lock, open(self.path, "a") as f:
+            f.write("\n" + "\n".join(ids))
+            self.ids.update(ids)
+
+    def count_failures(self, ids, limit):
+        ids = list(ids)
+        with self.lock:
+            self.failures.update(ids)
+            given_up = {i for i in ids if self.failures[i] >= limit}
+            for i in given_up: del self.failures[i]
+        return given_up
+
+    def compact(self, ttl):
+        return 0 # we don't know when anything was added
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SQLiteSeenStore(Database):
+    "Seen ids in an indexed sqlite table so we never have to load them all"
+    schema = """
+        CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY, seen_at REAL NOT NULL) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS seen_at_idx ON seen (seen_at);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS failures (id TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID;
+    """
+
+    def __contains__(self, id_):
+        return bool(self.execute("SELECT 1 FROM seen WHERE id = ?", (id_,)))
+
+    def __len__(self):
+        return self.execute("SELECT count(*) FROM seen")[0][0]
+
+    def all_ids(self):
+        return (r[0] for r in self.execute("SELECT id FROM seen"))
+
+    def seen_many(self, ids):
+        "The subset of ids that we've seen before, looked up in batches"
+        found = set()
+        for chunk in chunks(list(ids)):
+            rows = self.execute(f"SELECT id FROM seen WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            found.update(r[0] for r in rows)
+        return found
+
+    def add_many(self, ids):
+        now = datetime.now(timezone.utc).timestamp()
+        self.executemany("INSERT OR IGNORE INTO seen (id, seen_at) VALUES (?, ?)", ((str(i), now) for i in ids))
+
+    def count_failures(self, ids, limit):
+        """Count another run that failed to get the details of each of ids,
+        returning the ones that have now failed limit times and forgetting their counts"""
+        ids = list(set(ids))
+        self.executemany(
+            "INSERT INTO failures (id, count) VALUES (?, 1) ON CONFLICT (id) DO UPDATE SET count = count + 1", ((i,) for i in ids)
+        )
+        given_up = set()
+        for chunk in chunks(ids):
+            rows = self.execute(f"SELECT id FROM failures WHERE count >= ? AND id IN ({','.join('?' * len(chunk))})", [limit, *chunk])
+            given_up.update(r[0] for r in rows)
+        self.executemany("DELETE FROM failures WHERE id = ?", ((i,) for i in given_up))
+        return given_up
+
+    def compact(self, ttl):
+        "Forget ids first seen longer than ttl (a timedelta) ago"
+        cutoff = (datetime.now(timezone.utc) - ttl).timestamp()
+        with self.lock:
+            n = self.conn.execute("DELETE FROM seen WHERE seen_at < ?", (cutoff,)).rowcount
+            # and the failure counts of anything that got its details in the end
+            self.conn.execute("DELETE FROM failures WHERE id IN (SELECT id FROM seen)")
+        if n: logger.info(f"Forgot {n} properties seen more than {ttl.days} days ago.")
+        return n
+
+    def migrate_from_text(self, path):
+        "Copy the ids from an old seen.txt file in, only ever done once per database"
+        path = Path(path)
+        if self.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'") or not path.exists():
+            return
+        with open(path, "r") as f:
+            ids = [i for i in f.read().split("\n") if i != ""]
+        # We don't know when these were seen so treat them as seen now rather than expiring them straight away
+        self.add_many(ids)
+        self.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (str(path),))
+        logger.info(f"Migrated {len(ids)} seen properties from {path} to {self.path}")
+
+
+class BloomFilteredStore:
+    """Puts a Bloom filter in front of another seen store.
+    Ids the filter has never seen are known to be new without asking the store, only possible hits get checked exactly."""
+
+    def __init__(self, store, path, capacity = 1_000_000):
+        self.store = store
+        self.lock = threading.Lock()
+        self.bloom = BloomFilter(path, capacity = capacity)
+        # The filter has to contain everything in the store or we'd report seen properties as new.
+        # If they've drifted apart (e.g. after compaction or the filter filling up) start it again from the store.
+        n = len(store)
+        if self.bloom.count != n or n > self.bloom.capacity:
+            logger.info(f"Rebuilding Bloom filter {path} from {n} seen ids")
+            self.bloom.rebuild(store.all_ids(), capacity = max(capacity, 2 * n))
+
+    def __contains__(self, id_):
+        return id_ in self.bloom and id_ in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def all_ids(self):
+        return self.store.all_ids()
+
+    def seen_many(self, ids):
+        return self.store.seen_many([i for i in ids if i in self.bloom])
+
+    def add_many(self, ids):
+        ids = list(dict.fromkeys(str(i) for i in ids))
+        with self.lock:
+            already = self.store.seen_many(ids)
+            new = [i for i in ids if i not in already]
+            self.store.add_many(new)
+            self.bloom.add_many(new)
+
+    def count_failures(self, ids, limit):
+        return self.store.count_failures(ids, limit)
+
+    def compact(self, ttl):
+        n = self.store.compact(ttl)
+        if n: self.bloom.rebuild(self.store.all_ids(), capacity = max(self.bloom.capacity, 2 * len(self.store)))
+        return n
+
+    def close(self):
+        self.bloom.close()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReadOnlySeen:
+    "A view of a seen store that never adds anything to it, so a dry run leaves the next real run unchanged"
+
+    def __init__(self, store):
+        self.store = store
+
+    def seen_many(self, ids):
+        return self.store.seen_many(ids)
+
+    def add_many(self, ids):
+        pass
+
+    def count_failures(self, ids, limit):
+        return set()
+
+
+def open_seen_store(config, read_only = False):
+    """Open the store of properties we've already seen, as configured by the optional seen_store block.
+    Defaults to an sqlite database next to checked_properties_list, migrating the ids from it the first time.
+    With read_only, for dry runs, nothing on disk is created, migrated, compacted or rebuilt,
+    though it's up to the caller not to add anything."""
+    options = config.get("seen_store", {})
+    text_path = config["checked_properties_list"]
+    sqlite_path = Path(options.get("path") or Path(text_path).with_suffix(".sqlite"))
+
+    if options.get("backend", "sqlite") == "text":
+        store = TextSeenStore(text_path, create = not read_only)
+    elif read_only and not sqlite_path.exists():
+        # Not migrated yet, the text file is still the one with everything in
+        store = TextSeenStore(text_path, create = False)
+    else:
+        store = SQLiteSeenStore(sqlite_path, read_only = read_only)
+        if not read_only: store.migrate_from_text(text_path)
+    if read_only: return store
+
+    if options.get("bloom"):
+        # Put the filter file next to the seen list
+        store = BloomFilteredStore(store, Path(text_path).with_suffix(".bloom"), capacity = options.get("bloom_capacity", 1_000_000))
+
+    if options.get("ttl_days"):
+        store.compact(timedelta(days = options["ttl_days"]))
+    return store
@@ -0,0 +1,299 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from copy import copy
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from math import ceil
+from multiprocessing.util import Finalize
+from pathlib import Path
+import os
+import sqlite3
+
+import requests
+
+import logging
+logger = logging.getLogger("")
+
+from scrape import Search, load_config, make_search, parse_start_date, post_debug_message, give_up_on
+from fetch import Fetcher, make_session
+from seen import open_seen_store
+from rules import compile_rules
+from httpcache import open_http_cache
+from delivery import SlackDelivery, SeenOrQueued, open_outbox
+from dedup import open_listing_index
+from details import open_detail_store
+from history import open_history
+from metrics import metrics
+
+# Running the bot for several people at once. Each tenant has their own config file, with their own searches, slack
+# token and channel, seen list and outbox, and a runner config lists them along with what they share:
+#
+#   tenants: [data/alice.yml, data/bob.yml]
+#   processes: 4 # defaults to one per core
+#   http_cache: ...        # shared by everyone, like the blocks of the same name in a normal config
+#   openrent_details: ...
+#   concurrency: ...       # split between the processes, so the sites see the same load however many there are
+#
+# A run goes
+#   1. every distinct search url is fetched and parsed once, in a process pool, and checked against the rules of each
+#      tenant that has a search for it
+#   2. each tenant's seen store drops what they've already had
+#   3. the union of what's left gets its extra info fetched once, again spread over the pool
+#   4. each tenant's rules are checked again against their own copy of each property, then it's deduped, recorded
+#      and posted to their slack exactly like a normal run
+# Tenants' stores are only ever opened by this process, the workers just fetch and parse, sending back their metrics
+# with each result so the run's numbers cover everything.
+
+
+@dataclass
+class Tenant:
+    name: str
+    config: dict
+    search_infos: list
+    seen: object = field(default = None, repr = False)
+    outbox: object = field(default = None, repr = False)
+
+
+def state_paths(config):
+    "The files a tenant's own state is kept in, which mustn't be shared with anyone else"
+    paths = {
+        "checked_properties_list": config["checked_properties_list"],
+        "outbox": config.get("outbox", "data/outbox.sqlite"),
+    }
+    if (config.get("seen_store") or {}).get("path"): paths["seen_store"] = config["seen_store"]["path"]
+    for block, default in (("dedup", "data/listings.sqlite"), ("history", "data/history.sqlite")):
+        if config.get(block): paths[block] = config[block].get("path", default)
+    return {name : Path(path).resolve() for name, path in paths.items()}
+
+
+def load_tenants(runner_config):
+    "A Tenant for each config file in the runner config, refusing to run if any of them would share state"
+    tenants, owners = [], {}
+    for path in runner_config["tenants"]:
+        config = load_config(path)
+        parse_start_date(config)
+        tenant = Tenant(Path(path).stem, config, [Search(**s) for s in config["searches"]])
+        for name, state in state_paths(config).items():
+            if state in owners:
+                raise ValueError(f"{tenant.name} and {owners[state]} both keep state in {state}, give {tenant.name} its own {name}")
+            owners[state] = tenant.name
+        tenants.append(tenant)
+    return tenants
+
+
+def shard_searches(tenants):
+    "Group every tenant's searches by what gets fetched, (url, max_pages) -> [(tenant name, tenant config, Search)]"
+    shards = {}
+    for tenant in tenants:
+        for search_info in tenant.search_infos:
+            shards.setdefault((search_info.url, search_info.max_pages), []).append((tenant.name, tenant.config, search_info))
+    return shards
+
+
+# Each worker process' session, fetcher and detail store, set up once by init_worker
+worker = {}
+
+def init_worker(config, processes):
+    concurrency = dict(config.get("concurrency", {}))
+    # Every process has its own limits, so share the configured ones out between them
+    concurrency["rate"] = concurrency.get("rate", 5) / processes
+    for key, default in (("burst", 5), ("per_host", 2), ("max_per_host", 8)):
+        concurrency[key] = max(concurrency.get(key, default) // processes, 1)
+    worker["cache"] = open_http_cache(config)
+    worker["session"] = make_session(cache = worker["cache"])
+    worker["fetcher"] = Fetcher.from_config(worker["session"], dict(config, concurrency = concurrency))
+    worker["details"] = open_detail_store(config)
+    # The pool has no hook for a worker stopping, so close everything as its process exits
+    Finalize(None, close_worker, exitpriority = 10)
+
+
+def close_worker():
+    "Close a worker's session and stores, the HTTP cache trims itself to max_size as it closes"
+    worker["session"].close()
+    for store in (worker["cache"], worker["details"]):
+        if store is not None: store.close()
+
+
+def search_shard(config, members):
+    """Run the search that members, a list of (tenant name, tenant config, Search), have in common.
+    Returns the search, keeping only the properties that pass at least one of their rules,
+    for each (tenant name, search name) the ids that passed that search's rules, and the metrics for doing it."""
+    metrics.reset()
+    search = make_search(members[0][2], dict(config, columnar = False), worker["details"])
+    # An OperationalError is another worker still holding the shared HTTP cache or detail store after db.BUSY_TIMEOUT,
+    # it only costs us this search rather than the run for every tenant
+    try:
+        search.make_request(worker["fetcher"])
+    except (requests.RequestException, ValueError, sqlite3.OperationalError) as e:
+        logger.error(f"Search {search.url} failed, carrying on without it: {e}")
+        search.properties, search.prices = {}, {}
+
+    passed, keep = {}, set()
+    for tenant_name, tenant_config, search_info in members:
+        rules = compile_rules(tenant_config, search_info)
+        ids = [id_ for id_, prop in search.properties.items() if rules(prop)[0]]
+        passed[tenant_name, search_info.name] = ids
+        keep.update(ids)
+    search.properties = {id_ : prop for id_, prop in search.properties.items() if id_ in keep}
+    # Don't send back anything but the properties, the detail store stays in this process
+    search.details = None
+    if getattr(search, "columns", None): search.columns = {}
+    return search, passed, metrics.to_dict()
+
+
+def enrich_shard(search):
+    """Get the extra info for a search's properties, returning the ones we got it for, the ids of the ones that have gone
+    and the ones we couldn't read (see scrape.give_up_on), and the metrics for doing it"""
+    metrics.reset()
+    search.details = worker["details"]
+    try:
+        got_info = search.more_info(worker["fetcher"])
+    except (requests.RequestException, ValueError, sqlite3.OperationalError) as e:
+        logger.error(f"Couldn't get extra info for {len(search.properties)} properties: {e}")
+        got_info = set()
+    properties = {id_ : prop for id_, prop in search.properties.items() if id_ in got_info}
+    return properties, search.gone, search.broken, metrics.to_dict()
+
+
+def enrichment_jobs(candidates, templates, processes):
+    "Split the candidates up into about one search per process for each site, keeping OpenRent's in whole API batches"
+    by_kind = {}
+    for prop in candidates.values():
+        by_kind.setdefault(type(templates[prop.id]), {})[prop.id] = prop
+    for kind, props in by_kind.items():
+        size = ceil(len(props) / processes / kind.details_batch) * kind.details_batch
+        ids = list(props)
+        for i in range(0, len(ids), size):
+            chunk = {id_ : props[id_] for id_ in ids[i : i + size]}
+            yield replace(templates[ids[i]], name = "shared", properties = chunk, prices = {})
+
+
+def finish_tenant(tenant, claims, enriched, gone, broken, prices, started, dry_run):
+    """Check a tenant's candidates against their rules again now they've got their extra info,
+    then dedup, record and post what's left just like scrape.main"""
+    config = tenant.config
+    rules = {s.name : compile_rules(config, s) for s in tenant.search_infos}
+    order = [s.name for s in tenant.search_infos]
+    properties, rejected, kept, reasons = {}, set(), Counter(), {name : Counter() for name in order}
+    for id_, names in claims.items():
+        if id_ not in enriched: continue
+        # Their own copy, the keywords found depend on whose rules found them
+        prop = copy(enriched[id_])
+        keeper = None
+        for name in sorted(names, key = order.index):
+            ok, reason = rules[name](prop, verbose = True)
+            reasons[name][reason] += 1
+            if ok:
+                # Like run_searches, it gets the keywords from the last search that kept it
+                keeper, keywords = name, prop.keywords
+                kept[name] += 1
+        if keeper is None:
+            rejected.add(id_)
+            continue
+        prop.keywords = keywords
+        properties[id_] = prop
+
+    lines = [f"Ran {len(tenant.search_infos)} searches for {tenant.name}"]
+    for name in order:
+        lines.append(f"{name}: {kept[name]} of the results match our criteria after getting extra info.")
+        lines.append(f"Reasons: {', '.join(f'{k}:{v}' for k, v in reasons[name].items())}")
+
+    if dry_run:
+        logger.info("\n".join(lines))
+        logger.info(f"{tenant.name}: overall we found {len(properties)} new properties.")
+        for prop in properties.values():
+            logger.info(f"{tenant.name} {prop.id}: £{prop.price} {prop.bedrooms} bed {prop.title} {prop.url}")
+        return properties
+
+    tenant.seen.add_many(rejected)
+    give_up_on(tenant.seen, gone & claims.keys(), broken & claims.keys(), config)
+    listings = open_listing_index(config)
+    if listings is not None:
+        properties, duplicates = listings.drop_duplicates(properties)
+        lines.append(f"{len(duplicates)} of them are duplicates of properties we've already found.")
+        logger.info(f"{tenant.name}: {lines[-1]}")
+        tenant.seen.add_many(duplicates)
+        listings.close()
+    lines.append(f"Overall we found {len(properties)} new properties.")
+    logger.info(f"{tenant.name}: overall we found {len(properties)} new properties.")
+
+    from slack_sdk import WebClient
+    sc = WebClient(token = config["slack_token"])
+    post_debug_message(sc, config, properties, "\n".join(lines))
+    delivery = SlackDelivery.from_config(sc, tenant.outbox, tenant.seen, config)
+    history = open_history(config)
+    if history is not None:
+        history.observe(prices)
+        history.record((enriched[id_] for id_ in claims if id_ in enriched), matched = properties.keys())
+        delivery.queue_price_drops(config, history.price_drops(started))
+        history.close()
+    delivery.deliver(config, properties)
+    return properties
+
+
+def run_tenants(runner_config, dry_run = False):
+    """Run every tenant's searches once, sharing fetching and parsing between them,
+    returning {tenant name: the new properties found for them}"""
+    tenants = load_tenants(runner_config)
+    processes = runner_config.get("processes") or os.cpu_count()
+    shards = shard_searches(tenants)
+    started = datetime.now(timezone.utc).timestamp()
+    logger.info(f"Running {sum(len(t.search_infos) for t in tenants)} searches for {len(tenants)} tenants, "
+                f"{len(shards)} of them distinct, over {processes} processes")
+
+    with ExitStack() as stack:
+        for tenant in tenants:
+            tenant.seen = stack.enter_context(open_seen_store(tenant.config, read_only = dry_run))
+            tenant.outbox = stack.enter_context(open_outbox(tenant.config, read_only = dry_run))
+
+        with ProcessPoolExecutor(processes, initializer = init_worker, initargs = (runner_config, processes)) as pool:
+            # 1. Fetch and parse each distinct search once
+            with metrics.stage("search"):
+                results = list(pool.map(search_shard, [runner_config] * len(shards), shards.values()))
+
+            # 2. Drop what each tenant has already seen, noting which of their searches found what's left
+            parsed, templates = {}, {}
+            found = {tenant.name : {} for tenant in tenants}
+            prices = {tenant.name : {} for tenant in tenants}
+            for (search, passed, worker_metrics), members in zip(results, shards.values()):
+                metrics.merge(worker_metrics)
+                for id_, prop in search.properties.items():
+                    parsed.setdefault(id_, prop)
+                    templates.setdefault(id_, search)
+                for tenant_name, _, _ in members:
+                    prices[tenant_name].update(search.prices)
+                for (tenant_name, search_name), ids in passed.items():
+                    for id_ in ids: found[tenant_name].setdefault(id_, []).append(search_name)
+
+            claims = {}
+            for tenant in tenants:
+                already_seen = SeenOrQueued(tenant.seen, tenant.outbox)
+                seen = already_seen.seen_many(found[tenant.name].keys())
+                claims[tenant.name] = {id_ : names for id_, names in found[tenant.name].items() if id_ not in seen}
+                logger.info(f"{tenant.name}: {len(claims[tenant.name])} of the results are new to them")
+
+            # 3. Get the extra info for everything any tenant is still interested in, once
+            candidates = {id_ : parsed[id_] for tenant_claims in claims.values() for id_ in tenant_claims}
+            enriched, gone, broken = {}, set(), set()
+            with metrics.stage("enrich"):
+                for properties, shard_gone, shard_broken, worker_metrics in pool.map(
+                    enrich_shard, enrichment_jobs(candidates, templates, processes)
+                ):
+                    enriched.update(properties)
+                    gone |= shard_gone
+                    broken |= shard_broken
+                    metrics.merge(worker_metrics)
+            logger.info(f"Got extra info for {len(enriched)} properties between {len(tenants)} tenants")
+
+        # 4. Everything from here on is separate for each tenant
+        results = {}
+        for tenant in tenants:
+            try:
+                results[tenant.name] = finish_tenant(
+                    tenant, claims[tenant.name], enriched, gone, broken, prices[tenant.name], started, dry_run,
+                )
+            except Exception:
+                # One tenant's slack being down shouldn't stop everyone else getting theirs
+                logger.exception(f"Couldn't finish the run for {tenant.name}")
+    return results
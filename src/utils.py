@@ -1,10 +1,67 @@
+from collections.abc import Mapping, MutableMapping
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from itertools import islice
 from random import randint
-import numpy as np
+import importlib
+import math
+import sys
+import threading
+import types
 
-@dataclass
+class LazyModule(types.ModuleType):
+    "Stands in for a module until one of its attributes is used, then imports it"
+    _lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        # importlib's LazyLoader isn't safe to trigger from several threads at once before 3.12,
+        # and the searches run in a thread pool, so import under a lock instead
+        with self._lock:
+            module = importlib.import_module(self.__name__)
+            # Copy the module over so later lookups don't come back through here
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+def lazy_import(name):
+    """Import a module the first time one of its attributes is used rather than now,
+    so heavy dependencies like numpy only slow down the runs that need them"""
+    return sys.modules.get(name) or LazyModule(name)
+
+class RawData(MutableMapping):
+    """A property's raw data, kept as layers that are only merged into a dict when something reads it.
+    A layer is a mapping, or a function returning one, later layers overriding earlier ones.
+    Most properties are rejected before anyone looks at their raw data, so most never get merged."""
+    __slots__ = ("layers", "merged")
+
+    def __init__(self, *layers):
+        self.layers = list(layers)
+        self.merged = None
+
+    def add(self, layer):
+        if self.merged is None: self.layers.append(layer)
+        else: self.merged.update(layer() if callable(layer) else layer)
+
+    def update(self, other = (), **kwargs):
+        # Keep it as a layer rather than merging now, the way MutableMapping.update would
+        self.add(dict(other, **kwargs) if kwargs or not isinstance(other, Mapping) else other)
+
+    def as_dict(self):
+        if self.merged is None:
+            merged = {}
+            for layer in self.layers: merged.update(layer() if callable(layer) else layer)
+            self.merged, self.layers = merged, None
+        return self.merged
+
+    def __getitem__(self, key): return self.as_dict()[key]
+    def __setitem__(self, key, value): self.as_dict()[key] = value
+    def __delitem__(self, key): del self.as_dict()[key]
+    def __iter__(self): return iter(self.as_dict())
+    def __len__(self): return len(self.as_dict())
+    def __repr__(self): return f"RawData({self.as_dict()!r})"
+    # Pickle as the merged dict, the layers can hold on to far more than this property's data
+    def __reduce__(self): return (RawData, (self.as_dict(),))
+
+@dataclass(slots = True)
 class Property:
     id : tuple
     title : str = None
@@ -42,8 +99,16 @@ class Property:
     isLive : bool = None
     letAgreed : bool = None
 
-    rawData : dict = None
+    rawData : Mapping = None
     slack_channel : str = None
+    keywords : list = None # the search keywords found in the description, set by rules.KeywordRule
+
+def already_have(ids, seen = None, shared = None):
+    """Split ids into the ones seen(ids) says we've seen in an earlier run, and of the rest,
+    the ones shared(ids) says another search has already parsed in this one. Either function can be None."""
+    old = seen(ids) if seen else set()
+    elsewhere = shared([i for i in ids if i not in old]) if shared else set()
+    return old, elsewhere
 
 def random_chunk(li, min_chunk=5, max_chunk=19):
     "split a list into randomly sized chunks"
@@ -55,6 +120,16 @@ def random_chunk(li, min_chunk=5, max_chunk=19):
         else:
             break
 
+def fixed_chunk(li, size):
+    "split a list into chunks of size, the last one may be smaller"
+    it = iter(li)
+    while True:
+        nxt = list(islice(it, size))
+        if nxt:
+            yield nxt
+        else:
+            break
+
 def pairs(li):
     "split a list into randomly sized chunks"
     i = iter(li)
@@ -75,7 +150,7 @@ def fmt_timedelta(dt):
         (7, "day"),
         (4, "week"),
         (12, "month"),
-        (np.inf, "year")
+        (math.inf, "year")
     ]
 
     #start in seconds and iteratively find the largest interval
@@ -0,0 +1,37 @@
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from dedup import ListingIndex
+from utils import Property
+
+
+def flat(id_, description, **kwargs):
+    values = dict(title = "2 bedroom flat to rent", description = description,
+                  latitude = 51.5413, longitude = -0.1426, price = 2100, bedrooms = 2)
+    return Property(id = id_, **(values | kwargs))
+
+
+def test_same_flat_on_openrent_and_rightmove():
+    index = ListingIndex(":memory:")
+    openrent = flat("openrent:1", "Bright flat with a balcony, no fees, message the landlord directly on OpenRent")
+    rightmove = flat("rightmove:2", "Marketed by Foxtons. A stunning two double bedroom apartment moments from Camden Town station", price = 2150)
+    kept, duplicates = index.drop_duplicates({openrent.id : openrent, rightmove.id : rightmove})
+    assert list(kept) == ["openrent:1"]
+    assert duplicates == ["rightmove:2"]
+
+
+def test_across_portals_needs_price_and_bedrooms():
+    index = ListingIndex(":memory:")
+    openrent = flat("openrent:1", "Bright flat with a balcony", bedrooms = None)
+    rightmove = flat("rightmove:2", "Bright flat with a balcony")
+    kept, duplicates = index.drop_duplicates({openrent.id : openrent, rightmove.id : rightmove})
+    assert duplicates == []
+
+
+def test_same_portal_still_compares_descriptions():
+    index = ListingIndex(":memory:")
+    first = flat("rightmove:1", "Bright flat with a balcony overlooking the canal, close to the market")
+    second = flat("rightmove:2", "Garden studio conversion, newly refurbished kitchen and bathroom throughout")
+    kept, duplicates = index.drop_duplicates({first.id : first, second.id : second})
+    assert duplicates == []